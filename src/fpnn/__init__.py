@@ -2,6 +2,11 @@ from fpnn.quest import *
 from fpnn.tcp_client import *
 from fpnn.fpnn_error import *
 from fpnn.tcp_connection import ProcessorConnectionInfo
+from fpnn.client_engine import ShardedClientEngine
+from fpnn.thread_pool import *
+from fpnn.dns_cache import *
+from fpnn.flow_control import *
 from fpnn.error_recorder import *
 from fpnn.fpnn_error import *
-from fpnn.fpnn_client import *
\ No newline at end of file
+from fpnn.fpnn_client import *
+from fpnn.async_tcp_client import *
@@ -0,0 +1,281 @@
+#encoding=utf8
+
+import asyncio
+import inspect
+import functools
+from .quest import *
+from .quest import SEQUNCE
+from .fpnn_error import *
+from .tcp_client import ConnectionCallback, QuestProcessor
+from .tcp_connection import PackageReader, ProcessorConnectionInfo, TCPConnection, decode_quest, decode_answer, EMPTY_ANSWER, EMPTY_ANSWER_SEQUNCE_OFFSET
+from .client_engine import ClientEngine
+
+__all__ = ('AsyncTCPClient', )
+
+class FPNNProtocol(asyncio.BufferedProtocol):
+    def __init__(self, client):
+        self.client = client
+        self.loop = client.loop
+        self.connection_id = TCPConnection.get_id()
+        self.transport = None
+        self.closed = False
+        self.processor = client.processor
+        self.callback_map = {}
+        self.package_reader = PackageReader(self.handle_package)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.clean_callback()
+        self.client.notice_closed(self, exc != None)
+
+    def get_buffer(self, sizehint):
+        return self.package_reader.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.package_reader.buffer_updated(nbytes)
+
+    def eof_received(self):
+        return False
+
+    def close(self):
+        if self.transport != None and not self.closed:
+            self.transport.close()
+
+    def send_quest(self, quest, timeout):
+        buffer = quest.raw()
+        future = None
+        if not quest.oneway:
+            future = self.loop.create_future()
+            timer = None
+            if timeout > 0:
+                timer = self.loop.call_later(timeout / 1000, self.expire_quest, quest.sequnce_num, future)
+            self.callback_map[quest.sequnce_num] = (future, timer)
+            future.add_done_callback(functools.partial(self.quest_done, quest.sequnce_num))
+        self.transport.write(buffer)
+        return future
+
+    def quest_done(self, sequnce_num, future):
+        if not future.cancelled():
+            return
+        item = self.callback_map.get(sequnce_num, None)
+        if item == None or item[0] is not future:
+            return
+        del self.callback_map[sequnce_num]
+        if item[1] != None:
+            item[1].cancel()
+
+    def send_answer(self, answer):
+        if not self.closed:
+            self.transport.write(answer.raw())
+
+    def send_ack(self, sequnce_num):
+        if not self.closed:
+            frame = bytearray(EMPTY_ANSWER)
+            SEQUNCE.pack_into(frame, EMPTY_ANSWER_SEQUNCE_OFFSET, sequnce_num)
+            self.transport.write(frame)
+
+    def expire_quest(self, sequnce_num, future):
+        item = self.callback_map.get(sequnce_num, None)
+        if item == None or item[0] is not future:
+            return
+        del self.callback_map[sequnce_num]
+        if not future.done():
+            answer = Answer()
+            answer.sequnce_num = sequnce_num
+            answer.set_error(FPNN_ERROR.FPNN_EC_CORE_TIMEOUT.value, 'quest timeout')
+            future.set_result(answer)
+
+    def clean_callback(self):
+        callback_map = self.callback_map
+        self.callback_map = {}
+        for (sequnce_num, (future, timer)) in callback_map.items():
+            if timer != None:
+                timer.cancel()
+            if not future.done():
+                answer = Answer()
+                answer.sequnce_num = sequnce_num
+                answer.set_error(FPNN_ERROR.FPNN_EC_CORE_CONNECTION_CLOSED.value, 'connection is closed')
+                future.set_result(answer)
+
+    def handle_package(self, package):
+        if package.mtype == FpnnMType.FPNN_MT_ANSWER.value:
+            item = self.callback_map.pop(package.sequnce_num, None)
+            if item == None:
+                return
+            future, timer = item
+            if timer != None:
+                timer.cancel()
+            if not future.done():
+                future.set_result(decode_answer(package))
+            return
+
+        if self.processor == None:
+            return
+        if package.method == None or package.payload == None:
+            return
+        method = package.method.decode('utf-8')
+        if not hasattr(self.processor, method):
+            return
+        quest = decode_quest(package)
+        self.process_quest(getattr(self.processor, method), quest)
+
+    def process_quest(self, obj, quest):
+        processor_connection_info = ProcessorConnectionInfo(self, quest)
+        try:
+            answer = obj(processor_connection_info, quest)
+        except Exception as ex:
+            self.client.record_error(str(ex))
+            return
+        if inspect.isawaitable(answer):
+            self.loop.create_task(self.process_async_quest(processor_connection_info, quest, answer))
+        elif not quest.oneway and answer != None:
+            processor_connection_info.send_answer(answer)
+
+    async def process_async_quest(self, processor_connection_info, quest, awaitable):
+        try:
+            answer = await awaitable
+        except Exception as ex:
+            self.client.record_error(str(ex))
+            return
+        if not quest.oneway and answer != None:
+            processor_connection_info.send_answer(answer)
+
+class AsyncTCPClient(object):
+    def __init__(self, host, port, auto_reconnect = True, loop = None):
+        self.host = host
+        self.port = port
+        self.endpoint = host + ':' + str(port)
+        self.auto_reconnect = auto_reconnect
+        self.loop = loop
+        self.processor = None
+        self.connection_callback = None
+        self.error_recorder = None
+        self.quest_timeout = 0
+        self.connect_timeout = 0
+        self.protocol = None
+        self.connecting = None
+
+    def set_auto_connect(self, auto_reconnect):
+        self.auto_reconnect = auto_reconnect
+
+    def set_connect_timeout(self, milliseconds):
+        self.connect_timeout = milliseconds
+
+    def set_quest_timeout(self, milliseconds):
+        self.quest_timeout = milliseconds
+
+    def set_error_recorder(self, recorder):
+        self.error_recorder = recorder
+
+    def record_error(self, message):
+        recorder = self.error_recorder or ClientEngine.error_recorder
+        if recorder != None:
+            recorder.record_error(message)
+
+    def set_quest_processor(self, processor):
+        if not isinstance(processor, QuestProcessor):
+            raise Exception("processor type error")
+        self.processor = processor
+        if self.protocol != None:
+            self.protocol.processor = processor
+
+    def set_connection_callback(self, callback):
+        if not isinstance(callback, ConnectionCallback):
+            raise Exception("callback type error")
+        self.connection_callback = callback
+
+    def is_connected(self):
+        return self.protocol != None and not self.protocol.closed
+
+    async def connect(self):
+        if self.is_connected():
+            return True
+        if self.connecting == None:
+            self.connecting = asyncio.ensure_future(self.open_connection())
+        try:
+            return await asyncio.shield(self.connecting)
+        finally:
+            if self.connecting != None and self.connecting.done():
+                self.connecting = None
+
+    async def open_connection(self):
+        if self.loop == None:
+            self.loop = asyncio.get_running_loop()
+        try:
+            connect = self.loop.create_connection(lambda: FPNNProtocol(self), self.host, self.port)
+            if self.connect_timeout > 0:
+                transport, protocol = await asyncio.wait_for(connect, self.connect_timeout / 1000)
+            else:
+                transport, protocol = await connect
+        except Exception as ex:
+            self.record_error("connect got exception: " + str(ex))
+            if self.connection_callback != None:
+                self.connection_callback.connected(0, self.endpoint, False)
+            return False
+
+        self.protocol = protocol
+        if self.connection_callback != None:
+            self.connection_callback.connected(protocol.connection_id, self.endpoint, True)
+        return True
+
+    def notice_closed(self, protocol, caused_by_error):
+        if self.protocol is protocol:
+            self.protocol = None
+        if self.connection_callback != None:
+            self.connection_callback.closed(protocol.connection_id, self.endpoint, caused_by_error)
+
+    async def send_quest(self, quest, timeout = 0):
+        if not isinstance(quest, Quest):
+            raise Exception("quest type error")
+
+        quest.create_sequnce_num()
+
+        if not self.is_connected():
+            if not self.auto_reconnect or not await self.connect():
+                return self.invalid_answer(quest)
+
+        # the peer may have closed the connection while connect() was awaited
+        protocol = self.protocol
+        if protocol == None or protocol.closed:
+            return self.invalid_answer(quest)
+
+        if timeout == 0:
+            timeout = self.quest_timeout
+
+        future = protocol.send_quest(quest, timeout)
+        if future == None:
+            return None
+        return await future
+
+    def send_quest_nowait(self, quest, timeout = 0):
+        if not isinstance(quest, Quest):
+            raise Exception("quest type error")
+
+        protocol = self.protocol
+        if protocol == None or protocol.closed:
+            return asyncio.ensure_future(self.send_quest(quest, timeout), loop = self.loop)
+
+        quest.create_sequnce_num()
+        if timeout == 0:
+            timeout = self.quest_timeout
+        return protocol.send_quest(quest, timeout)
+
+    def invalid_answer(self, quest):
+        if quest.oneway:
+            return None
+        answer = Answer()
+        answer.sequnce_num = quest.sequnce_num
+        answer.set_error(FPNN_ERROR.FPNN_EC_CORE_INVALID_CONNECTION.value, 'invalid connection')
+        return answer
+
+    def close(self):
+        if self.protocol != None:
+            protocol = self.protocol
+            self.protocol = None
+            protocol.close()
+
+    def destory(self):
+        self.close()
@@ -2,7 +2,8 @@
 
 import os
 import time
-import errno
+import heapq
+import itertools
 import threading
 import selectors
 import socket
@@ -15,100 +16,117 @@ class ReadySocketInfo(object):
         self.can_read = read
         self.can_write = write
 
+class QuestTimeoutScheduler(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = None
+
+    def add(self, timeout, fn, args):
+        deadline = time.monotonic() + timeout / 1000
+        with self.lock:
+            earliest = len(self.heap) == 0 or deadline < self.heap[0][0]
+            heapq.heappush(self.heap, (deadline, next(self.counter), fn, args))
+        if earliest and self.wakeup != None:
+            self.wakeup()
+
+    def next_timeout(self):
+        with self.lock:
+            if len(self.heap) == 0:
+                return None
+            return max(0, self.heap[0][0] - time.monotonic())
+
+    def expire(self):
+        now = time.monotonic()
+        expired = []
+        with self.lock:
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                expired.append(heapq.heappop(self.heap))
+        for (deadline, index, fn, args) in expired:
+            try:
+                fn(*args)
+            except Exception as ex:
+                if ClientEngine.error_recorder != None:
+                    ClientEngine.error_recorder.record_error("timeout task got exception: " + str(ex))
+
 class ClientEngine(object):
     error_recorder = None
 
-    def __init__(self):
-        self.init()
+    def __init__(self, thread_pool = None, timeout_scheduler = None):
+        self.init(thread_pool, timeout_scheduler)
 
-    def init(self):
+    def init(self, thread_pool = None, timeout_scheduler = None):
         self.running = True
         self.loop_thread = None
         self.lock = threading.Lock()
         self.want_write_lock = threading.Lock()
-        self.thread_pool_executor = ThreadPool()
+        self.own_thread_pool = thread_pool == None
+        self.thread_pool_executor = ThreadPool() if thread_pool == None else thread_pool
+        self.drive_timeout = timeout_scheduler == None
+        if timeout_scheduler == None:
+            timeout_scheduler = QuestTimeoutScheduler()
+            timeout_scheduler.wakeup = self.next_loop
+        self.timeout_scheduler = timeout_scheduler
         self.notify_lock = threading.Lock()
-        self.read_notify_fd, self.write_notify_fd = os.pipe()
-        os.set_blocking(self.read_notify_fd, False)
-        os.set_blocking(self.write_notify_fd, False)
-        self.read_notify = os.fdopen(self.read_notify_fd)
-        self.write_notify = os.fdopen(self.write_notify_fd, 'w')
+        self.wakeup_pending = False
+        self.read_notify, self.write_notify = socket.socketpair()
+        self.read_notify.setblocking(False)
+        self.write_notify.setblocking(False)
         self.connection_map = {}
         self.new_socket_set = set()
         self.quit_socket_set = set()
+        self.close_socket_set = set()
         self.want_write_socket_set = set()
+        self.write_changed_socket_set = set()
         self.loop_thread = threading.Thread(target=ClientEngine.loop, args=(self,))
         self.loop_thread.setDaemon(True)
         self.loop_thread.start()
-        self.check_thread = threading.Thread(target=ClientEngine.check, args=(self,))
-        self.check_thread.setDaemon(True)
-        self.check_thread.start()
 
     def stop(self):
         self.running = False
         self.next_loop()
         if self.loop_thread != None:
             self.loop_thread.join()
-        if self.check_thread != None:
-            self.check_thread.join()
+        for s in self.close_socket_set:
+            try:
+                s.close()
+            except:
+                pass
+        self.close_socket_set.clear()
         self.read_notify.close()
         self.write_notify.close()
-        self.thread_pool_executor.close()
-
-    def check(self):
-        while self.running:
-            cyc = 10
-            while self.running:
-                cyc -= 1
-                if cyc == 0:
-                    break
-                time.sleep(0.1)
-            self.check_timeout()
-
-    def check_timeout(self):
-        with self.lock:
-            for (socket_fd, connection) in  self.connection_map.items(): 
-                connection.check_timeout()
+        if self.own_thread_pool:
+            self.thread_pool_executor.close()
 
     def thread_pool_execute(self, fn, args):
-        self.thread_pool_executor.run(fn, args)
+        # callbacks of the engine are never held back by the task queue bound
+        return self.thread_pool_executor.run(fn, args, bounded = False)
+
+    def thread_pool_metrics(self):
+        return self.thread_pool_executor.metrics()
 
     def loop(self):
         selector = selectors.DefaultSelector()
 
         selector.register(
-            self.read_notify_fd,
+            self.read_notify,
             selectors.EVENT_READ,
         )
 
-        all_socket = set()
-        want_write_socket = set()
-        
+        registered_socket = {}
+
         while self.running:
-            with self.lock:
-
-                for s in all_socket:
-                    if s in self.quit_socket_set:
-                        continue
-                    try:
-                        selector.unregister(s)
-                    except KeyError:
-                        pass
-                    if s in want_write_socket:
-                        selector.register(
-                            s,
-                            selectors.EVENT_READ | selectors.EVENT_WRITE,
-                        )
-                    else:
-                        selector.register(
-                            s,
-                            selectors.EVENT_READ,
-                        )
+            self.update_registration(selector, registered_socket)
 
             ready_socket_set = set()
 
-            for key, mask in selector.select():
-                if key.fileobj == self.read_notify_fd:
+            select_timeout = None
+            if self.drive_timeout:
+                select_timeout = self.timeout_scheduler.next_timeout()
+
+            for key, mask in selector.select(select_timeout):
+                if key.fileobj == self.read_notify:
                     self.consume_notify()
 
                 if not self.running:
@@ -116,10 +134,10 @@ class ClientEngine(object):
 
                 canRead = False
                 canWrite = False
-                if mask & selectors.EVENT_READ and key.fileobj != self.read_notify_fd:
+                if mask & selectors.EVENT_READ and key.fileobj != self.read_notify:
                     canRead = True
 
-                if mask & selectors.EVENT_WRITE and key.fileobj != self.read_notify_fd:
+                if mask & selectors.EVENT_WRITE and key.fileobj != self.read_notify:
                     canWrite = True
                 
                 if canRead or canWrite:
@@ -131,20 +149,67 @@ class ClientEngine(object):
             for s in ready_socket_set:
                 self.process_connection_io(s)
 
-            with self.lock:
-                if len(self.new_socket_set) > 0:
-                    all_socket.update(self.new_socket_set)
-                    self.new_socket_set.clear()
+            if self.drive_timeout:
+                self.timeout_scheduler.expire()
 
+    def update_registration(self, selector, registered_socket):
+        with self.lock:
+            with self.want_write_lock:
                 if len(self.quit_socket_set) > 0:
                     for s in self.quit_socket_set:
-                        all_socket.remove(s)
+                        # a socket handed over from a connect attempt quits and joins in the same batch
+                        if s not in self.new_socket_set:
+                            self.want_write_socket_set.discard(s)
+                            self.write_changed_socket_set.discard(s)
+                        if registered_socket.pop(s, None) != None:
+                            try:
+                                selector.unregister(s)
+                            except (KeyError, ValueError, OSError):
+                                pass
                     self.quit_socket_set.clear()
 
-            with self.want_write_lock:
-                want_write_socket.clear()
-                if len(self.want_write_socket_set) > 0:
-                    want_write_socket.update(self.want_write_socket_set)
+                if len(self.close_socket_set) > 0:
+                    # sockets are closed only after they are unregistered, so the fd is never reused while registered
+                    for s in self.close_socket_set:
+                        self.new_socket_set.discard(s)
+                        self.want_write_socket_set.discard(s)
+                        self.write_changed_socket_set.discard(s)
+                        try:
+                            s.close()
+                        except:
+                            pass
+                    self.close_socket_set.clear()
+
+                if len(self.new_socket_set) > 0:
+                    for s in self.new_socket_set:
+                        self.write_changed_socket_set.discard(s)
+                        events = selectors.EVENT_READ
+                        if s in self.want_write_socket_set:
+                            events |= selectors.EVENT_WRITE
+                        try:
+                            selector.register(s, events)
+                            registered_socket[s] = events
+                        except (KeyError, ValueError, OSError) as error:
+                            if ClientEngine.error_recorder != None:
+                                ClientEngine.error_recorder.record_error("register socket got error: " + str(error))
+                    self.new_socket_set.clear()
+
+                if len(self.write_changed_socket_set) > 0:
+                    for s in self.write_changed_socket_set:
+                        events = registered_socket.get(s, None)
+                        if events == None:
+                            continue
+                        if s in self.want_write_socket_set:
+                            want_events = selectors.EVENT_READ | selectors.EVENT_WRITE
+                        else:
+                            want_events = selectors.EVENT_READ
+                        if want_events != events:
+                            try:
+                                selector.modify(s, want_events)
+                                registered_socket[s] = want_events
+                            except (KeyError, ValueError, OSError):
+                                pass
+                    self.write_changed_socket_set.clear()
 
     def process_connection_io(self, si):
         with self.lock:
@@ -158,52 +223,152 @@ class ClientEngine(object):
             self.new_socket_set.add(connection.socket)
         self.next_loop()
 
-    def quit(self, connection):
+    def join_in_loop(self, connection):
+        # no lock for run in IO loop thread
+        self.connection_map[connection.socket] = connection
+        self.new_socket_set.add(connection.socket)
+        self.next_loop()
+
+    def quit(self, connection, close = False):
+        # close the socket in the IO loop once it is unregistered
         if connection == None:
-            return
+            return False
         with self.lock:
-            del self.connection_map[connection.socket]
+            if self.connection_map.pop(connection.socket, None) == None:
+                return False
             self.quit_socket_set.add(connection.socket)
+            if close:
+                self.close_socket_set.add(connection.socket)
         self.next_loop()
+        return True
 
-    def quit_in_loop(self, connection):
+    def quit_in_loop(self, connection, close = False):
         # no lock for run in IO loop thread
         if connection == None:
-            return
-        del self.connection_map[connection.socket]
+            return False
+        if self.connection_map.pop(connection.socket, None) == None:
+            return False
         self.quit_socket_set.add(connection.socket)
+        if close:
+            self.close_socket_set.add(connection.socket)
         self.next_loop()
+        return True
 
     def require_write(self, connection):
         with self.want_write_lock:
+            if connection.socket in self.want_write_socket_set:
+                return
             self.want_write_socket_set.add(connection.socket)
+            self.write_changed_socket_set.add(connection.socket)
         self.next_loop() 
 
     def release_write(self, connection):
         with self.want_write_lock:
-            try:
+            if connection.socket in self.want_write_socket_set:
                 self.want_write_socket_set.remove(connection.socket)
-                self.next_loop()
-            except KeyError:
-                pass
+                self.write_changed_socket_set.add(connection.socket)
         
     def next_loop(self):
         with self.notify_lock:
-            self.write_notify.write("0")
-            self.write_notify.flush()
+            if self.wakeup_pending:
+                return
+            self.wakeup_pending = True
+        try:
+            self.write_notify.send(b'0')
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as error:
+            if ClientEngine.error_recorder != None:
+                ClientEngine.error_recorder.record_error("notify loop got error: " + str(error.errno))
 
     def consume_notify(self):
+        # drain before clearing the flag, a wakeup sent while draining would otherwise be swallowed
+        # and leave the flag set with nothing to read. a next_loop() suppressed before the flag is
+        # cleared is covered by update_registration, which runs before the next select
         while True:
             try:
-                os.read(self.read_notify_fd, 1)
-            except BlockingIOError as error:
-                break
-            except IOError as error:
-                if error.errno == errno.EAGAIN or error.errno == errno.EWOULDBLOCK or error.errno == errno.EINTR:
-                    continue
-                else:
-                    if ClientEngine.error_recorder != None:
-                        ClientEngine.error_recorder.record_error("consume notify got error: " + error.errno)
+                if len(self.read_notify.recv(4096)) == 0:
                     break
+            except InterruptedError:
+                continue
+            except BlockingIOError:
+                break
+            except OSError as error:
+                if ClientEngine.error_recorder != None:
+                    ClientEngine.error_recorder.record_error("consume notify got error: " + str(error.errno))
+                break
+        with self.notify_lock:
+            self.wakeup_pending = False
+
+
+class ShardedClientEngine(object):
+    shared_engine = None
+    shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, shard_count = None, thread_pool = None):
+        with cls.shared_lock:
+            if cls.shared_engine == None:
+                cls.shared_engine = ShardedClientEngine(shard_count, thread_pool)
+            return cls.shared_engine
+
+    @classmethod
+    def stop_shared(cls):
+        with cls.shared_lock:
+            engine = cls.shared_engine
+            cls.shared_engine = None
+        if engine != None:
+            engine.stop()
+
+    def __init__(self, shard_count = None, thread_pool = None):
+        if shard_count == None:
+            shard_count = os.cpu_count() or 1
+        if shard_count < 1:
+            raise Exception("shard count must be greater than 0")
+        self.running = True
+        self.own_thread_pool = thread_pool == None
+        self.thread_pool_executor = ThreadPool() if thread_pool == None else thread_pool
+        first_shard = ClientEngine(self.thread_pool_executor)
+        self.timeout_scheduler = first_shard.timeout_scheduler
+        self.shards = [first_shard]
+        for i in range(shard_count - 1):
+            self.shards.append(ClientEngine(self.thread_pool_executor, self.timeout_scheduler))
+
+    def shard(self, connection):
+        return self.shards[connection.connection_id % len(self.shards)]
+
+    def stop(self):
+        self.running = False
+        for shard in self.shards:
+            shard.stop()
+        if self.own_thread_pool:
+            self.thread_pool_executor.close()
+
+    def thread_pool_execute(self, fn, args):
+        # callbacks of the engine are never held back by the task queue bound
+        return self.thread_pool_executor.run(fn, args, bounded = False)
+
+    def thread_pool_metrics(self):
+        return self.thread_pool_executor.metrics()
+
+    def join(self, connection):
+        self.shard(connection).join(connection)
 
+    def join_in_loop(self, connection):
+        self.shard(connection).join_in_loop(connection)
 
+    def quit(self, connection, close = False):
+        if connection == None:
+            return False
+        return self.shard(connection).quit(connection, close)
+
+    def quit_in_loop(self, connection, close = False):
+        if connection == None:
+            return False
+        return self.shard(connection).quit_in_loop(connection, close)
+
+    def require_write(self, connection):
+        self.shard(connection).require_write(connection)
+
+    def release_write(self, connection):
+        self.shard(connection).release_write(connection)
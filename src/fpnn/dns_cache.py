@@ -0,0 +1,80 @@
+#encoding=utf8
+
+import time
+import socket
+import threading
+
+__all__ = ('DNSCache', )
+
+class DNSCache(object):
+    shared_cache = None
+    shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        with cls.shared_lock:
+            if cls.shared_cache == None:
+                cls.shared_cache = DNSCache()
+            return cls.shared_cache
+
+    def __init__(self, ttl = 60, max_size = 1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.cache = {}
+
+    def set_ttl(self, seconds):
+        self.ttl = seconds
+
+    def resolve(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            item = self.cache.get(key, None)
+            if item != None and item[0] > now:
+                return item[1]
+
+        addresses = self.interleave(socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM))
+
+        if self.ttl > 0 and len(addresses) > 0:
+            with self.lock:
+                if len(self.cache) >= self.max_size and key not in self.cache:
+                    self.purge(now)
+                self.cache[key] = (now + self.ttl, addresses)
+        return addresses
+
+    def invalidate(self, host, port):
+        with self.lock:
+            self.cache.pop((host, port), None)
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def purge(self, now):
+        for key in [key for (key, item) in self.cache.items() if item[0] <= now]:
+            del self.cache[key]
+        if len(self.cache) >= self.max_size:
+            del self.cache[next(iter(self.cache))]
+
+    @staticmethod
+    def interleave(infos):
+        # alternate address families, keeping the resolver's preference for the first one
+        families = {}
+        order = []
+        for (family, type, proto, canonname, sockaddr) in infos:
+            if family not in families:
+                families[family] = []
+                order.append(family)
+            address = (family, sockaddr)
+            if address not in families[family]:
+                families[family].append(address)
+
+        addresses = []
+        index = 0
+        while len(addresses) < sum(len(items) for items in families.values()):
+            for family in order:
+                if index < len(families[family]):
+                    addresses.append(families[family][index])
+            index += 1
+        return tuple(addresses)
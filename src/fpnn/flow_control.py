@@ -0,0 +1,30 @@
+#encoding=utf8
+
+from enum import Enum
+
+__all__ = ('OverflowPolicy', 'QueueOverflowError', 'Watermark')
+
+class OverflowPolicy(Enum):
+    Block = 1
+    DropOldest = 2
+    DropNewest = 3
+    Raise = 4
+
+class QueueOverflowError(Exception):
+    pass
+
+class Watermark(object):
+    def __init__(self, high_bytes = 0, low_bytes = None, high_count = 0, low_count = None, policy = OverflowPolicy.Block):
+        if not isinstance(policy, OverflowPolicy):
+            raise Exception("policy type error")
+        self.high_bytes = high_bytes
+        self.low_bytes = int(high_bytes / 2) if low_bytes == None else low_bytes
+        self.high_count = high_count
+        self.low_count = int(high_count / 2) if low_count == None else low_count
+        self.policy = policy
+
+    def over_high(self, size, count):
+        return (self.high_bytes > 0 and size >= self.high_bytes) or (self.high_count > 0 and count >= self.high_count)
+
+    def under_low(self, size, count):
+        return (self.high_bytes <= 0 or size <= self.low_bytes) and (self.high_count <= 0 or count <= self.low_count)
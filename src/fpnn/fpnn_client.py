@@ -24,6 +24,20 @@ FPNN_FLAG_MSGPACK = 0x80
 FPNN_MT_ONEWAY = 0
 FPNN_MT_TWOWAY = 1
 FPNN_MT_ANSWER = 2
+FPNN_MAGIC = b'FPNN'
+
+FPNN_HEADER = struct.Struct('<4sBBBBI')
+FPNN_HEADER_SEQ = struct.Struct('<4sBBBBII')
+FPNN_LENGTH = struct.Struct('<I')
+
+packerLocal = threading.local()
+
+def packPayload(params):
+    packer = getattr(packerLocal, 'packer', None)
+    if packer is None:
+        packer = msgpack.Packer()
+        packerLocal.packer = packer
+    return packer.pack(params)
 
 class FpnnCallback:
     timeoutSecond = 0
@@ -55,8 +69,7 @@ class FPNNHeader(object):
         self.psize = psize
 
     def pack(self):
-        return struct.pack('<4sBBBBI',
-                           self.magic.encode('utf-8'),
+        return FPNN_HEADER.pack(FPNN_MAGIC if self.magic == "FPNN" else self.magic.encode('utf-8'),
                            self.version,
                            self.flag,
                            self.mtype,
@@ -71,11 +84,11 @@ class FPNNQuest(object):
         self.header = FPNNHeader("FPNN", FPNN_PYTHON_VERSION, 0, 0, 0, 0)
         self.header.flag = FPNN_FLAG_MSGPACK
         self.header.mtype = FPNN_MT_ONEWAY if oneway else FPNN_MT_TWOWAY
-        self.header.ss = len(method)
+        self.method = method.encode('utf-8')
+        self.header.ss = len(self.method)
         if not oneway:
             self.seqNum = self.nextSeqNum()
-        self.method = method
-        self.payload = msgpack.packb(params)
+        self.payload = packPayload(params)
         self.header.psize = len(self.payload)
 
     @classmethod
@@ -86,12 +99,17 @@ class FPNNQuest(object):
         return cls.nextSeq
 
     def raw(self):
-        packet = self.header.pack()
-        if self.header.mtype == FPNN_MT_TWOWAY:
-            packet += struct.pack('<I', self.seqNum)
-        packet += struct.pack('!%ds%ds' % (len(self.method), len(self.payload)),
-                              self.method.encode('utf-8'),
-                              self.payload)
+        header = self.header
+        if header.mtype == FPNN_MT_TWOWAY:
+            offset = FPNN_HEADER_SEQ.size
+            packet = bytearray(offset + header.ss + header.psize)
+            FPNN_HEADER_SEQ.pack_into(packet, 0, FPNN_MAGIC, header.version, header.flag, header.mtype, header.ss, header.psize, self.seqNum)
+        else:
+            offset = FPNN_HEADER.size
+            packet = bytearray(offset + header.ss + header.psize)
+            FPNN_HEADER.pack_into(packet, 0, FPNN_MAGIC, header.version, header.flag, header.mtype, header.ss, header.psize)
+        packet[offset:offset + header.ss] = self.method
+        packet[offset + header.ss:] = self.payload
         return packet
     
 class FPNNAnswer(object):
@@ -101,13 +119,14 @@ class FPNNAnswer(object):
         self.header.mtype = FPNN_MT_ANSWER
         self.header.ss = 0
         self.seqNum = seqNum
-        self.payload = msgpack.packb(params)
+        self.payload = packPayload(params)
         self.header.psize = len(self.payload)
 
     def raw(self):
-        packet = self.header.pack()
-        packet += struct.pack('<I', self.seqNum)
-        packet += struct.pack('!%ds' % len(self.payload), self.payload)
+        header = self.header
+        packet = bytearray(FPNN_HEADER_SEQ.size + header.psize)
+        FPNN_HEADER_SEQ.pack_into(packet, 0, FPNN_MAGIC, header.version, header.flag, header.mtype, header.ss, header.psize, self.seqNum)
+        packet[FPNN_HEADER_SEQ.size:] = self.payload
         return packet
 
 class AsyncCallback(object):
@@ -277,6 +296,7 @@ class FPNNTCPClient(object):
                 self.key = secret
             else:
                 self.key = hashlib.sha256(secret).digest()
+        self.cipher = Cipher(algorithms.AES(self.key), modes.CFB(self.iv), backend = default_backend())
 
         self.isEncryptor = True
         self.canEncryptor = False
@@ -285,12 +305,11 @@ class FPNNTCPClient(object):
         self.sendQuest("*key", {"publicKey" : sendPubKey, "streamMode" : False, "bits" : self.strength})
 
     def encrypt(self, buffer, isEncrypt):
-        cipher = Cipher(algorithms.AES(self.key), modes.CFB(self.iv), backend = default_backend())
         if isEncrypt:
-            encryptor = cipher.encryptor()
+            encryptor = self.cipher.encryptor()
             return encryptor.update(buffer) + encryptor.finalize()
         else:
-            decryptor = cipher.decryptor()
+            decryptor = self.cipher.decryptor()
             return decryptor.update(buffer) + decryptor.finalize()
 
     def sendAll(self, buffer):
@@ -337,13 +356,13 @@ class FPNNTCPClient(object):
                 buffer = None
                 if self.isEncryptor:
                     buffer = self.recvAll(4)
-                    arr = struct.unpack('<I', buffer)
+                    arr = FPNN_LENGTH.unpack(buffer)
                     buffer = self.recvAll(arr[0])
                     buffer = self.encrypt(buffer, False)
-                    arr = struct.unpack('<4sBBBBII' + str(arr[0] - 16) + 's', buffer)
+                    arr = FPNN_HEADER_SEQ.unpack_from(buffer, 0) + (buffer[FPNN_HEADER_SEQ.size:], )
                 else:
                     buffer = self.recvAll(16)
-                    arr = struct.unpack('<4sBBBBII', buffer)
+                    arr = FPNN_HEADER_SEQ.unpack(buffer)
 
                 mtype = arr[3]
 
@@ -436,7 +455,7 @@ class FPNNTCPClient(object):
 
             if self.isEncryptor and method != "*key":
                 encryptBuffer = self.encrypt(buffer, True)
-                buffer = struct.pack('<I' + str(len(buffer)) + 's', len(buffer), encryptBuffer.encode('utf-8'))
+                buffer = FPNN_LENGTH.pack(len(buffer)) + encryptBuffer
 
             self.sendAll(buffer)
 
@@ -3,11 +3,47 @@
 import time
 import struct
 import msgpack
+import threading
 from enum import Enum
 
 __all__ = ('Quest', 'Answer', 'FpnnMType')
 
 FPNN_FLAG_MSGPACK = 0x80
+FPNN_MAGIC = b'FPNN'
+
+HEADER = struct.Struct('<4sBBBBI')
+HEADER_SEQUNCE = struct.Struct('<4sBBBBII')
+SEQUNCE = struct.Struct('<I')
+
+packer_local = threading.local()
+
+def payload_packer():
+    packer = getattr(packer_local, 'packer', None)
+    if packer == None:
+        packer = msgpack.Packer(autoreset = False)
+        packer_local.packer = packer
+    return packer
+
+def build_packet(header, method, sequnce_num, params):
+    # the payload is packed into the thread's packer buffer and copied once into the frame
+    packer = payload_packer()
+    try:
+        packer.pack(params)
+        with packer.getbuffer() as payload:
+            header.psize = len(payload)
+            if sequnce_num == None:
+                offset = HEADER.size
+                packet = bytearray(offset + len(method) + header.psize)
+                HEADER.pack_into(packet, 0, FPNN_MAGIC, header.version, header.flag, header.mtype, header.ss, header.psize)
+            else:
+                offset = HEADER_SEQUNCE.size
+                packet = bytearray(offset + len(method) + header.psize)
+                HEADER_SEQUNCE.pack_into(packet, 0, FPNN_MAGIC, header.version, header.flag, header.mtype, header.ss, header.psize, sequnce_num)
+            packet[offset:offset + len(method)] = method
+            packet[offset + len(method):] = payload
+    finally:
+        packer.reset()
+    return packet
 
 class FpnnMType(Enum):
     FPNN_MT_ONEWAY = 0
@@ -24,8 +60,7 @@ class Header(object):
         self.psize = psize
 
     def pack(self):
-        return struct.pack('<4sBBBBI',
-                           self.magic.encode('utf-8'),
+        return HEADER.pack(FPNN_MAGIC if self.magic == "FPNN" else self.magic.encode('utf-8'),
                            self.version,
                            self.flag,
                            self.mtype,
@@ -76,18 +111,11 @@ class Quest(Message):
     def raw(self):
         self.header.flag = FPNN_FLAG_MSGPACK
         self.header.mtype = FpnnMType.FPNN_MT_ONEWAY.value if self.oneway else FpnnMType.FPNN_MT_TWOWAY.value
-        self.header.ss = len(self.method)
+        method = self.method.encode('utf-8')
+        self.header.ss = len(method)
         if not self.oneway and self.sequnce_num == None:
             self.sequnce_num = self.next_sequnce_num()
-        self.payload = msgpack.packb(self.params_map)
-        self.header.psize = len(self.payload)
-        packet = self.header.pack()
-        if self.header.mtype == FpnnMType.FPNN_MT_TWOWAY.value:
-            packet += struct.pack('<I', self.sequnce_num)
-        packet += struct.pack('!%ds%ds' % (len(self.method), len(self.payload)),
-                              self.method.encode('utf-8'),
-                              self.payload)
-        return packet
+        return build_packet(self.header, method, None if self.oneway else self.sequnce_num, self.params_map)
 
     def create_sequnce_num(self):
         if not self.oneway:
@@ -102,10 +130,28 @@ class Quest(Message):
 
 class Answer(Message):
     def __init__(self, params = None):
+        self.lazy_params = None
         Message.__init__(self, params)
         self.sequnce_num = None
         self.error_code = None
-        self.error_message = None            
+        self.error_message = None
+
+    @property
+    def params_map(self):
+        lazy = self.lazy_params
+        if lazy != None:
+            self.params = lazy[1](lazy[0])
+            self.lazy_params = None
+        return self.params
+
+    @params_map.setter
+    def params_map(self, params):
+        self.lazy_params = None
+        self.params = params
+
+    def defer_params(self, payload, unpack):
+        # the payload is only unpacked when the params are read
+        self.lazy_params = (payload, unpack)
 
     def __str__(self):
         if self.is_error():
@@ -130,16 +176,8 @@ class Answer(Message):
         self.header.flag = FPNN_FLAG_MSGPACK
         self.header.mtype = FpnnMType.FPNN_MT_ANSWER.value
         if self.is_error():
-            self.payload = msgpack.packb({'code': self.error_code, 'ex': self.error_code})
             self.header.ss = 1
+            return build_packet(self.header, b'', self.sequnce_num, {'code': self.error_code, 'ex': self.error_message})
         else:
-            self.payload = msgpack.packb(self.params_map)
             self.header.ss = 0
-        self.header.psize = len(self.payload)
-        packet = self.header.pack()
-        packet += struct.pack('<I', self.sequnce_num)
-        packet += struct.pack('!%ds' % (len(self.payload)),
-                              self.payload)
-        return packet
-
-    
\ No newline at end of file
+            return build_packet(self.header, b'', self.sequnce_num, self.params_map)
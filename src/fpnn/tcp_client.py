@@ -1,10 +1,13 @@
 #encoding=utf8
 
 import threading
-import socket
 import hashlib
 from enum import Enum
+from concurrent.futures import Future
 from .client_engine import ClientEngine
+from .dns_cache import DNSCache
+from .thread_pool import SerialLanes
+from .flow_control import *
 from .tcp_connection import *
 from .quest import *
 from .fpnn_error import *
@@ -14,7 +17,7 @@ from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography import utils
 
-__all__ = ('ConnectionCallback', 'QuestCallback', 'QuestProcessor', 'TCPClient', 'FPNN_SDK_VERSION')
+__all__ = ('ConnectionCallback', 'QuestCallback', 'QuestProcessor', 'QuestFuture', 'DispatchMode', 'TCPClient', 'FPNN_SDK_VERSION')
 
 FPNN_SDK_VERSION = '2.0.6'
 
@@ -31,16 +34,66 @@ class ConnectionCallback(object):
     def closed(self, connection_id, endpoint, caused_by_error):
         pass
 
+    def writable(self, connection_id, endpoint):
+        pass
+
 class QuestCallback(object):
+    # set to False when the callback only checks is_error(), the answer params are then decoded on first access
+    need_answer_body = True
+
     def callback(self, answer):
         pass
 
+class QuestFuture(Future):
+    def __init__(self):
+        Future.__init__(self)
+        self.connection = None
+        self.sequnce_num = None
+        self.fpnn_callback = None
+
+    def set_answer(self, answer):
+        if self.cancelled():
+            return
+        try:
+            self.set_result(answer)
+        except:
+            pass
+
+    def cancel(self):
+        if not Future.cancel(self):
+            return False
+        if self.connection != None:
+            self.connection.cancel_quest(self.sequnce_num, self.fpnn_callback)
+        return True
+
+class KeyExchangeCallback(QuestCallback):
+    def __init__(self, client, connection):
+        self.client = client
+        self.connection = connection
+
+    def callback(self, answer):
+        self.client.notice_key_exchanged(self.connection, answer)
+
+class DispatchMode(Enum):
+    Pool = 1
+    Ordered = 2
+    Inline = 3
+
 class QuestProcessor(object):
     def __init__(self):
         pass
 
+    def dispatch_key(self, method, quest):
+        # quests with the same key are processed in order in DispatchMode.Ordered, None uses the shared pool
+        return None
+
+    def inline_handlers(self):
+        # {method: handler(params)} run on the IO thread in DispatchMode.Inline, a twoway quest is answered
+        # with an empty answer before its handler is called. handlers must not block
+        return {}
+
 class TCPClient(object):
-    def __init__(self, host, port, auto_reconnect = True):
+    def __init__(self, host, port, auto_reconnect = True, engine = None):
         self.lock = threading.Lock()
         self.auto_reconnect = auto_reconnect
         self.processor = None 
@@ -52,10 +105,17 @@ class TCPClient(object):
         self.encrypted_key = None
         self.encrypted_iv = None
         self.encrypted_send_pub_key = None
+        self.encrypted_stream_mode = False
         self.connect_status = ConnectionStatus.NoConnected
         self.quest_timeout = 0
         self.connect_timeout = 0
-        self.engine = ClientEngine()
+        self.write_watermark = None
+        self.dispatch_mode = DispatchMode.Pool
+        self.lanes = None
+        self.inline_table = None
+        self.own_engine = engine == None
+        self.engine = ClientEngine() if engine == None else engine
+        self.dns_cache = DNSCache.shared()
         self.connection_info = TCPConnectionInfo(host, port)
         self.current_connection = None
         self.error_recorder = None
@@ -71,6 +131,30 @@ class TCPClient(object):
     def set_quest_timeout(self, milliseconds):
         self.quest_timeout = milliseconds
 
+    def set_write_watermark(self, watermark):
+        if watermark != None and not isinstance(watermark, Watermark):
+            raise Exception("watermark type error")
+        self.write_watermark = watermark
+        connection = self.current_connection
+        if connection != None:
+            with connection.write_lock:
+                connection.watermark = watermark
+                connection.write_blocked = False
+                connection.writable.notify_all()
+
+    def queue_depth(self):
+        connection = self.current_connection
+        if connection == None:
+            return 0, 0
+        return connection.queue_depth()
+
+    def is_writable(self):
+        connection = self.current_connection
+        return connection == None or connection.is_writable()
+
+    def set_dns_cache(self, dns_cache):
+        self.dns_cache = dns_cache
+
     def set_error_recorder(self, recorder):
         self.error_recorder = recorder
         ClientEngine.error_recorder = recorder
@@ -82,6 +166,27 @@ class TCPClient(object):
         self.processor = processor
         if self.current_connection != None:
             self.current_connection.processor = processor
+        self.update_inline_table()
+
+    def set_dispatch_mode(self, mode):
+        if not isinstance(mode, DispatchMode):
+            raise Exception("dispatch mode type error")
+        if mode != DispatchMode.Ordered:
+            self.lanes = None
+        elif self.lanes == None:
+            self.lanes = SerialLanes(self.engine.thread_pool_execute)
+        self.dispatch_mode = mode
+        self.update_inline_table()
+
+    def update_inline_table(self):
+        # keyed by the method name bytes of the package, so no decoding happens before the lookup
+        if self.dispatch_mode != DispatchMode.Inline or self.processor == None:
+            self.inline_table = None
+            return
+        table = {}
+        for (method, handler) in self.processor.inline_handlers().items():
+            table[method.encode('utf-8')] = handler
+        self.inline_table = table
 
     def set_connection_callback(self, callback):
         if  not isinstance(callback, ConnectionCallback):
@@ -90,7 +195,7 @@ class TCPClient(object):
         if self.current_connection != None:
             self.current_connection.connection_callback = callback
 
-    def enable_encryptor_by_pem_file(self, pem_pub_file, curve_name = 'secp256k1', strength = 128):
+    def enable_encryptor_by_pem_file(self, pem_pub_file, curve_name = 'secp256k1', strength = 128, stream_mode = False):
         if not self.can_encryptor:
             raise Exception("can not enable encryptor after a quest send")
         if curve_name not in ['secp256k1', 'secp256r1', 'secp192r1', 'secp224r1']:
@@ -107,6 +212,7 @@ class TCPClient(object):
         if strength not in [128, 256]:
             strength = 128
         self.encryptor_strength = strength
+        self.encrypted_stream_mode = stream_mode
 
         pri_key = ec.generate_private_key(self.encryptor_curve, default_backend())
         pub_key = pri_key.public_key()
@@ -131,88 +237,118 @@ class TCPClient(object):
         if self.connection_callback != None:
             self.connection_callback.closed(connection_id, endpoint, caused_by_error)
 
+    def notice_writable(self, connection):
+        if self.connection_callback != None and self.current_connection is connection:
+            self.connection_callback.writable(connection.connection_id, self.connection_info.host + ':' + str(self.connection_info.port))
+
     def connect(self):
+        if self.connected:
+            return True
+
+        # resolve out of the client lock, a cache miss blocks in getaddrinfo
+        try:
+            addresses = self.dns_cache.resolve(self.connection_info.host, self.connection_info.port)
+        except Exception as ex:
+            if self.error_recorder != None:
+                self.error_recorder.record_error("resolve " + self.connection_info.host + " got exception: " + str(ex))
+            addresses = ()
+
         with self.lock:
             if self.connected:
                 return True
 
-            self.connect_status = ConnectionStatus.Connecting
-
-            socket_fd = 0
-            try:
-                server_address = (self.connection_info.host, self.connection_info.port)
-                socket_fd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                if self.connect_timeout > 0:
-                    socket_fd.settimeout(self.connect_timeout / 1000)
-                socket_fd.connect(server_address)
-                socket_fd.setblocking(False)
-            except:
-                self.connect_status = ConnectionStatus.NoConnected
-                self.engine.thread_pool_execute(self.connect_callback, (0, self.connection_info.host + ':' + str(self.connection_info.port), False))
-                return False
-        
-            if socket_fd == 0:
+            if len(addresses) == 0:
                 self.connect_status = ConnectionStatus.NoConnected
                 self.engine.thread_pool_execute(self.connect_callback, (0, self.connection_info.host + ':' + str(self.connection_info.port), False))
                 return False
 
-            self.current_connection = TCPConnection(self, self.engine, self.connection_info, socket_fd)
+            self.connect_status = ConnectionStatus.Connecting
+            connection = TCPConnection(self, self.engine, self.connection_info, None)
+            connection.connecting = True
+            connection.watermark = self.write_watermark
+            connection.racer = ConnectRacer(connection, addresses)
 
             if self.processor != None:
-                self.current_connection.processor = self.processor
+                connection.processor = self.processor
 
             if self.connection_callback != None:
-                self.current_connection.connection_callback = self.connection_callback
+                connection.connection_callback = self.connection_callback
 
+            self.current_connection = connection
             self.connected = True
-            self.connect_status = ConnectionStatus.Connected
-
-            self.engine.thread_pool_execute(self.connect_callback, (self.current_connection.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), True))
-
-            self.engine.join(self.current_connection)
 
             if self.encryptor_curve != None:
-                self.current_connection.connection_info.encrypted = True
-                self.current_connection.connection_info.encrypted_key = self.encrypted_key
-                self.current_connection.connection_info.encrypted_iv = self.encrypted_iv
-                self.current_connection.need_read_lenth = 4
-                self.current_connection.read_step = ReadPackageStep.READ_HEADER_ENCRYPTOR
+                connection.enable_encryptor(self.encrypted_key, self.encrypted_iv, self.encrypted_stream_mode)
 
+                # the key exchange is queued ahead of any other quest, quests sent
+                # before its answer arrives are pipelined behind it
                 encryptor_quest = Quest('*key')
                 encryptor_quest.param('publicKey', self.encrypted_send_pub_key)
-                encryptor_quest.param('streamMode', False)
+                encryptor_quest.param('streamMode', self.encrypted_stream_mode)
                 encryptor_quest.param('bits', self.encryptor_strength)
-                answer = self.send_quest(encryptor_quest)
-
-                if answer.is_error():
-                    self.engine.quit(self.current_connection)
-                    self.current_connection.clean_callback()
-                    self.engine.thread_pool_execute(self.close_callback, (self.current_connection.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), True))
-                    self.current_connection = None
-                    self.connected = False
-                    self.connect_status = ConnectionStatus.NoConnected
+                encryptor_quest.create_sequnce_num()
+                timeout = self.quest_timeout
+                connection.send_quest(encryptor_quest, FpnnQuestCallback(KeyExchangeCallback(self, connection), timeout), timeout)
 
             self.can_encryptor = False
-            return True
+
+        # attempts join the engine out of the client lock, the IO loop takes the engine lock first
+        if self.connect_timeout > 0:
+            self.engine.timeout_scheduler.add(self.connect_timeout, connection.expire_connect, ())
+        connection.racer.start()
+        return True
+
+    def notice_connected(self, connection):
+        with self.lock:
+            if self.current_connection is connection:
+                if self.encryptor_curve != None:
+                    self.connect_status = ConnectionStatus.KeyExchanging
+                else:
+                    self.connect_status = ConnectionStatus.Connected
+        self.engine.thread_pool_execute(self.connect_callback, (connection.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), True))
+
+    def notice_connect_failed(self, connection):
+        with self.lock:
+            if self.current_connection is not connection:
+                return
+            self.current_connection = None
+            self.connected = False
+            self.connect_status = ConnectionStatus.NoConnected
+        self.dns_cache.invalidate(self.connection_info.host, self.connection_info.port)
+
+    def notice_key_exchanged(self, connection, answer):
+        if answer.is_error():
+            if self.error_recorder != None:
+                self.error_recorder.record_error("key exchange failed: " + str(answer.error_code))
+            connection.abort(False)
+            return
+        with self.lock:
+            if self.current_connection is connection:
+                self.connect_status = ConnectionStatus.Connected
 
     def close(self):
         with self.lock:
             if not self.connected:
                 return
-            if self.current_connection != None:
-                self.engine.quit(self.current_connection)
-                self.current_connection.clean_callback()
-                self.engine.thread_pool_execute(self.close_callback, (self.current_connection.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), False))
-                self.current_connection = None
+            connection = self.current_connection
+            self.current_connection = None
             self.connected = False
             self.connect_status = ConnectionStatus.NoConnected
 
+        if connection == None or connection.cancel_connect():
+            return
+        if self.engine.quit(connection):
+            connection.clean_callback()
+            self.engine.thread_pool_execute(self.close_callback, (connection.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), False))
+
     def reconnect(self):
         self.close()
         return self.connect()
 
-    def notice_closed(self):
+    def notice_closed(self, connection):
         with self.lock:
+            if self.current_connection is not connection:
+                return
             self.current_connection = None
             self.connected = False
             self.connect_status = ConnectionStatus.NoConnected
@@ -234,7 +370,8 @@ class TCPClient(object):
                     answer.sequnce_num = quest.sequnce_num
                     answer.set_error(FPNN_ERROR.FPNN_EC_CORE_INVALID_CONNECTION.value, 'invalid connection')
                     if is_async:
-                        callback.callback(answer)
+                        if callback != None:
+                            callback.callback(answer)
                         return None
                     else:
                         return answer
@@ -243,7 +380,8 @@ class TCPClient(object):
                 answer.sequnce_num = quest.sequnce_num
                 answer.set_error(FPNN_ERROR.FPNN_EC_CORE_INVALID_CONNECTION.value, 'invalid connection')
                 if is_async:
-                    callback.callback(answer)
+                    if callback != None:
+                        callback.callback(answer)
                     return None
                 else:
                     return answer
@@ -251,6 +389,11 @@ class TCPClient(object):
         if timeout == 0:
             timeout = self.quest_timeout
 
+        if quest.oneway:
+            # no answer comes back for a oneway quest, so nothing is tracked
+            self.send(quest, None, 0)
+            return None
+
         fpnn_callback = FpnnQuestCallback(callback, timeout)
         if is_async:
             self.send(quest, fpnn_callback, timeout)
@@ -260,11 +403,54 @@ class TCPClient(object):
             fpnn_callback.sync_semaphore.acquire()
             return fpnn_callback.sync_answer
 
+    def send_quest_future(self, quest, timeout = 0):
+        if not isinstance(quest, Quest):
+            raise Exception("quest type error")
+
+        quest.create_sequnce_num()
+        future = QuestFuture()
+
+        if not self.connected and (not self.auto_reconnect or not self.connect()):
+            answer = Answer()
+            answer.sequnce_num = quest.sequnce_num
+            answer.set_error(FPNN_ERROR.FPNN_EC_CORE_INVALID_CONNECTION.value, 'invalid connection')
+            future.set_answer(answer)
+            return future
+
+        if timeout == 0:
+            timeout = self.quest_timeout
+
+        connection = self.current_connection
+        if connection == None:
+            answer = Answer()
+            answer.sequnce_num = quest.sequnce_num
+            answer.set_error(FPNN_ERROR.FPNN_EC_CORE_INVALID_CONNECTION.value, 'invalid connection')
+            future.set_answer(answer)
+            return future
+
+        fpnn_callback = FpnnQuestCallback(None, timeout)
+        fpnn_callback.future = future
+        future.connection = connection
+        future.sequnce_num = quest.sequnce_num
+        future.fpnn_callback = fpnn_callback
+        connection.send_quest(quest, fpnn_callback, timeout)
+        if quest.oneway:
+            future.set_answer(None)
+        return future
+
     def send(self, quest, callback, timeout):
-        if self.current_connection != None:
-            self.current_connection.send_quest(quest, callback, timeout)
+        connection = self.current_connection
+        if connection != None:
+            connection.send_quest(quest, callback, timeout)
+        else:
+            answer = Answer()
+            answer.sequnce_num = quest.sequnce_num
+            answer.set_error(FPNN_ERROR.FPNN_EC_CORE_INVALID_CONNECTION.value, 'invalid connection')
+            if callback != None:
+                callback.invoke(self.engine, answer)
 
     def destory(self):
         self.close()
-        self.engine.stop()
+        if self.own_engine:
+            self.engine.stop()
 
@@ -2,23 +2,24 @@
 
 import time
 import errno
+import re
+import codecs
 import threading
-import struct
 import socket
+import itertools
 import msgpack
-from enum import Enum
+from collections import deque
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from .quest import *
+from .quest import HEADER, SEQUNCE
 from .tcp_client import *
 from .fpnn_error import *
 from .client_engine import *
+from .flow_control import *
 
-class ReadPackageStep(Enum):
-    READ_HEADER_NO_ENCRYPTOR = 1
-    READ_LEFT_NO_ENCRYPTOR = 2
-    READ_HEADER_ENCRYPTOR = 3
-    READ_LEFT_ENCRYPTOR = 4
+WRITE_IOV_MAX = 1024
+CONNECT_ATTEMPT_DELAY = 250
 
 class ReadPackage(object):
     def __init__(self):
@@ -32,6 +33,163 @@ class ReadPackage(object):
         self.psize = None
         self.payload = None
 
+# threads whose current unpack escaped a str field. keyed by thread, so the IO, asyncio and pool threads
+# never see each other's escapes, and the clean path only tests the dict for emptiness
+escaped_threads = {}
+surrogate_escape = codecs.lookup_error('surrogateescape')
+surrogate_search = re.compile('[\udc80-\udcff]').search
+
+def escape_bin(error):
+    # str fields that are not valid utf-8 are escaped in place and marked for the thread, so the payload is decoded only once
+    escaped_threads[threading.get_ident()] = True
+    return surrogate_escape(error)
+
+codecs.register_error('fpnn.bin', escape_bin)
+
+def restore_bin(value):
+    if isinstance(value, str):
+        if not value.isascii() and surrogate_search(value):
+            return value.encode('utf-8', 'surrogateescape')
+    elif isinstance(value, dict):
+        for (key, item) in value.items():
+            if not isinstance(item, (int, float)):
+                value[key] = restore_bin(item)
+    elif isinstance(value, list):
+        for (index, item) in enumerate(value):
+            if not isinstance(item, (int, float)):
+                value[index] = restore_bin(item)
+    return value
+
+def unpack_fix_bin(payload):
+    # keys stay str, values that are not valid utf-8 are handed out as bytes
+    data = msgpack.unpackb(payload, raw = False, unicode_errors = 'fpnn.bin')
+    if escaped_threads and escaped_threads.pop(threading.get_ident(), False):
+        data = restore_bin(data)
+    return data
+
+def empty_answer_frame():
+    answer = Answer()
+    answer.sequnce_num = 0
+    return bytes(answer.raw())
+
+# only the sequence number differs between the acks of server pushes
+EMPTY_ANSWER = empty_answer_frame()
+EMPTY_ANSWER_SEQUNCE_OFFSET = HEADER.size
+
+def decode_quest(package):
+    quest = Quest(package.method, package.mtype == FpnnMType.FPNN_MT_ONEWAY.value)
+    quest.sequnce_num = package.sequnce_num
+    quest.params_map = unpack_fix_bin(package.payload)
+    return quest
+
+def decode_answer(package, lazy = False):
+    answer = Answer()
+    answer.sequnce_num = package.sequnce_num
+    if package.ss != 0:
+        data = unpack_fix_bin(package.payload)
+        answer.set_error(data.get("code", FPNN_ERROR.FPNN_EC_PROTO_UNKNOWN_ERROR.value), data.get("ex", "unknown error"))
+    elif lazy:
+        # the package buffer is reused once the handler returns
+        answer.defer_params(bytes(package.payload), unpack_fix_bin)
+    else:
+        answer.set_params(unpack_fix_bin(package.payload))
+    return answer
+
+class PackageReader(object):
+    def __init__(self, handler, decryptor = None, buffer_size = 65536):
+        self.handler = handler
+        self.decryptor = decryptor
+        self.encrypted = False
+        self.stream_decryptor = None
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.package = ReadPackage()
+
+    def get_buffer(self):
+        if self.end == len(self.buffer):
+            pending = self.end - self.start
+            if self.start > 0:
+                self.view[0:pending] = self.view[self.start:self.end]
+            else:
+                buffer = bytearray(len(self.buffer) * 2)
+                buffer[0:pending] = self.view[0:pending]
+                self.buffer = buffer
+                self.view = memoryview(self.buffer)
+            self.start = 0
+            self.end = pending
+        return self.view[self.end:]
+
+    def buffer_updated(self, nbytes):
+        if self.stream_decryptor != None:
+            self.view[self.end:self.end + nbytes] = self.stream_decryptor.update(self.view[self.end:self.end + nbytes])
+        self.end += nbytes
+        if self.encrypted:
+            self.parse_encrypted()
+        else:
+            self.parse()
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+
+    def feed(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            buffer = self.get_buffer()
+            count = min(len(buffer), len(data))
+            buffer[0:count] = data[0:count]
+            data = data[count:]
+            self.buffer_updated(count)
+
+    def parse(self):
+        while self.end - self.start >= 12:
+            arr = HEADER.unpack_from(self.buffer, self.start)
+            mtype = arr[3]
+            ss = arr[4]
+            psize = arr[5]
+            if mtype == FpnnMType.FPNN_MT_ONEWAY.value:
+                size = 12 + ss + psize
+            elif mtype == FpnnMType.FPNN_MT_TWOWAY.value:
+                size = 16 + ss + psize
+            else:
+                size = 16 + psize
+            if self.end - self.start < size:
+                return
+            self.dispatch(self.view, self.start, mtype, ss, psize)
+            self.start += size
+
+    def parse_encrypted(self):
+        while self.end - self.start >= 4:
+            length = SEQUNCE.unpack_from(self.buffer, self.start)[0]
+            if self.end - self.start < 4 + length:
+                return
+            data = self.decryptor(self.view[self.start + 4:self.start + 4 + length])
+            arr = HEADER.unpack_from(data, 0)
+            self.dispatch(memoryview(data), 0, arr[3], arr[4], arr[5])
+            self.start += 4 + length
+
+    def dispatch(self, view, offset, mtype, ss, psize):
+        package = self.package
+        package.mtype = mtype
+        package.ss = ss
+        package.psize = psize
+        offset += 12
+        if mtype == FpnnMType.FPNN_MT_ONEWAY.value:
+            package.method = bytes(view[offset:offset + ss])
+            package.payload = view[offset + ss:offset + ss + psize]
+        elif mtype == FpnnMType.FPNN_MT_TWOWAY.value:
+            package.sequnce_num = SEQUNCE.unpack_from(view, offset)[0]
+            package.method = bytes(view[offset + 4:offset + 4 + ss])
+            package.payload = view[offset + 4 + ss:offset + 4 + ss + psize]
+        else:
+            package.sequnce_num = SEQUNCE.unpack_from(view, offset)[0]
+            package.payload = view[offset + 4:offset + 4 + psize]
+        try:
+            self.handler(package)
+        finally:
+            package.reset()
+
 class FpnnQuestCallback(object):
     def __init__(self, callback, timeout):
         self.callback = callback
@@ -39,6 +197,21 @@ class FpnnQuestCallback(object):
         self.create_time = int(round(time.time() * 1000))
         self.sync_semaphore = None
         self.sync_answer = None
+        self.future = None
+
+    def invoke(self, engine, answer):
+        if self.sync_semaphore != None:
+            self.sync_answer = answer
+            self.sync_semaphore.release()
+        elif self.future != None:
+            # done callbacks of the future run on the pool, never in the IO loop or under a connection lock
+            if not engine.thread_pool_execute(self.future.set_answer, (answer, )):
+                self.future.set_answer(answer)
+        elif self.callback != None:
+            engine.thread_pool_execute(self.callback.callback, (answer, ))
+
+    def lazy_answer(self):
+        return self.sync_semaphore == None and self.future == None and self.callback != None and not self.callback.need_answer_body
 
 class ProcessorConnectionInfo(object):
     def __init__(self, tcp_connection, quest):
@@ -53,6 +226,10 @@ class ProcessorConnectionInfo(object):
         answer.sequnce_num = self.quest.sequnce_num
         self.connection.send_answer(answer)
 
+    def send_ack(self):
+        # an empty answer from the pre-encoded frame
+        self.connection.send_ack(self.quest.sequnce_num)
+
 class TCPConnectionInfo(object):
     def __init__(self, host, port):
         self.host = host
@@ -60,6 +237,114 @@ class TCPConnectionInfo(object):
         self.encrypted = False
         self.encrypted_key = None
         self.encrypted_iv = None
+        self.stream_mode = False
+
+class ConnectAttempt(object):
+    def __init__(self, racer, address):
+        self.racer = racer
+        # share the connection id so the attempt runs on the connection's engine shard
+        self.connection_id = racer.connection.connection_id
+        self.address = address
+        self.socket = socket.socket(address[0], socket.SOCK_STREAM)
+        self.socket.setblocking(False)
+        # set under the racer lock when the attempt is cancelled or lost the race
+        self.dropped = False
+
+    def start(self):
+        error = self.socket.connect_ex(self.address[1])
+        return error in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+
+    def process_io(self, can_read, can_write):
+        self.racer.attempt_ready(self)
+
+class ConnectRacer(object):
+    def __init__(self, connection, addresses, delay = CONNECT_ATTEMPT_DELAY):
+        self.connection = connection
+        self.engine = connection.engine
+        self.lock = threading.Lock()
+        self.pending = list(addresses)
+        self.attempts = []
+        self.delay = delay
+        self.done = False
+
+    def start(self):
+        while True:
+            with self.lock:
+                if self.done:
+                    return
+                if len(self.pending) == 0:
+                    failed = len(self.attempts) == 0
+                    self.done = failed
+                    break
+                attempt = ConnectAttempt(self, self.pending.pop(0))
+                if not attempt.start():
+                    attempt.socket.close()
+                    continue
+                self.attempts.append(attempt)
+                more = len(self.pending) > 0
+
+            self.engine.join(attempt)
+            with self.lock:
+                dropped = attempt.dropped
+            if dropped:
+                # dropped before it joined the engine, its quit found nothing to close
+                self.engine.quit(attempt, True)
+                return
+            self.engine.require_write(attempt)
+            if more:
+                self.engine.timeout_scheduler.add(self.delay, self.attempt_delayed, (attempt, ))
+            return
+
+        if failed:
+            self.connection.connect_failed()
+
+    def attempt_delayed(self, attempt):
+        with self.lock:
+            if self.done or attempt not in self.attempts:
+                return
+        self.start()
+
+    def attempt_ready(self, attempt):
+        # run in the IO loop thread of the attempt's shard
+        error = attempt.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        with self.lock:
+            if attempt in self.attempts:
+                self.attempts.remove(attempt)
+            done = self.done
+            won = error == 0 and not done
+            if won:
+                self.done = True
+                losers = self.attempts
+                self.attempts = []
+                for loser in losers:
+                    loser.dropped = True
+
+        # every socket but the winner's is closed by the loop after it is unregistered
+        self.engine.quit_in_loop(attempt, not won)
+        if done:
+            return
+        if error != 0:
+            if ClientEngine.error_recorder != None:
+                ClientEngine.error_recorder.record_error("connect " + str(attempt.address[1]) + " got error: " + str(error))
+            # start the next attempt out of the IO loop, the engine lock is held here
+            self.engine.timeout_scheduler.add(0, self.start, ())
+            return
+        for loser in losers:
+            self.engine.quit_in_loop(loser, True)
+        self.connection.connect_established(attempt.socket)
+
+    def cancel(self):
+        with self.lock:
+            if self.done:
+                return False
+            self.done = True
+            attempts = self.attempts
+            self.attempts = []
+            for attempt in attempts:
+                attempt.dropped = True
+        for attempt in attempts:
+            self.engine.quit(attempt, True)
+        return True
 
 class TCPConnection(object):
     next_id = 0
@@ -70,68 +355,219 @@ class TCPConnection(object):
         self.connection_info = info
         self.socket = sock
         self.write_lock = threading.Lock()
-        self.out_queue = []
-        self.in_buffer = bytearray(0)
+        self.writable = threading.Condition(self.write_lock)
+        self.out_queue = deque()
+        self.out_sequnce = deque()
+        self.queued_bytes = 0
+        self.watermark = None
+        self.write_blocked = False
         self.callback_map = {}
         self.callback_lock = threading.Lock()
         self.processor = None
         self.connection_callback = None
-        self.need_read_lenth = 12
-        self.read_step = ReadPackageStep.READ_HEADER_NO_ENCRYPTOR
-        if self.connection_info.encrypted:
-            self.need_read_lenth = 4
-            self.read_step = ReadPackageStep.READ_HEADER_ENCRYPTOR
-        self.read_package = ReadPackage()
+        self.package_reader = PackageReader(self.handle_package, self.decrypt)
+        self.connecting = False
+        self.closed = False
+        self.racer = None
+        self.cipher = None
+        self.stream_encryptor = None
+        self.decrypt_buffer = None
+        self.ack_batch = None
 
     def __del__(self):
-        self.socket.close()
+        if self.socket != None:
+            self.socket.close()
 
     @classmethod
     def get_id(cls):
         cls.next_id += 1
         return cls.next_id
 
-    def encrypt(self, buffer, is_encrypt):
-        cipher = Cipher(algorithms.AES(self.connection_info.encrypted_key), modes.CFB(self.connection_info.encrypted_iv), backend = default_backend())
-        if is_encrypt:
-            encryptor = cipher.encryptor()
-            return encryptor.update(buffer) + encryptor.finalize()
+    def enable_encryptor(self, key, iv, stream_mode):
+        self.connection_info.encrypted = True
+        self.connection_info.encrypted_key = key
+        self.connection_info.encrypted_iv = iv
+        self.connection_info.stream_mode = stream_mode
+        self.cipher = Cipher(algorithms.AES(key), modes.CFB(iv), backend = default_backend())
+        if stream_mode:
+            self.stream_encryptor = self.cipher.encryptor()
+            self.package_reader.stream_decryptor = self.cipher.decryptor()
         else:
-            decryptor = cipher.decryptor()
-            return decryptor.update(buffer) + decryptor.finalize()
+            self.package_reader.encrypted = True
+
+    def encrypt(self, buffer):
+        # package mode: every package restarts the CFB stream from the iv
+        encryptor = self.cipher.encryptor()
+        package = bytearray(4 + len(buffer) + 15)
+        view = memoryview(package)
+        SEQUNCE.pack_into(package, 0, len(buffer))
+        count = encryptor.update_into(buffer, view[4:])
+        encryptor.finalize()
+        view.release()
+        del package[4 + count:]
+        return package
+
+    def decrypt(self, buffer):
+        size = len(buffer) + 15
+        if self.decrypt_buffer == None or len(self.decrypt_buffer) < size:
+            self.decrypt_buffer = bytearray(max(size, 4096))
+        decryptor = self.cipher.decryptor()
+        count = decryptor.update_into(buffer, self.decrypt_buffer)
+        decryptor.finalize()
+        return memoryview(self.decrypt_buffer)[:count]
 
     def send_quest(self, quest, callback, timeout):
         buffer = quest.raw()
-        if self.connection_info.encrypted and quest.method != "*key":
-            encrypt_buffer = self.encrypt(buffer, True)
-            buffer = struct.pack('<I' + str(len(buffer)) + 's', len(buffer), encrypt_buffer)
+        encrypt = self.cipher != None and quest.method != "*key"
 
         with self.callback_lock:
-            self.callback_map[quest.sequnce_num] = callback
+            closed = self.closed
+            if not closed and not quest.oneway:
+                self.callback_map[quest.sequnce_num] = callback
+
+        if closed:
+            if callback != None:
+                answer = Answer()
+                answer.sequnce_num = quest.sequnce_num
+                answer.set_error(FPNN_ERROR.FPNN_EC_CORE_CONNECTION_CLOSED.value, 'connection is closed')
+                callback.invoke(self.engine, answer)
+            return
+
+        if callback != None and callback.timeout > 0:
+            self.engine.timeout_scheduler.add(callback.timeout, self.expire_quest, (quest.sequnce_num, callback))
 
+        # the key exchange is never held back or dropped by the watermark
+        flow = quest.method != "*key"
+        try:
+            sent = self.send_buffer(buffer, encrypt, 0 if quest.oneway else quest.sequnce_num, flow)
+        except QueueOverflowError:
+            self.drop_quest(quest.sequnce_num, callback, False)
+            raise
+        if not sent:
+            self.drop_quest(quest.sequnce_num, callback, True)
+
+    def send_buffer(self, buffer, encrypt = False, sequnce_num = None, flow = False):
+        # sequnce_num marks a quest package which may be dropped, 0 for oneway quests
+        if encrypt and self.stream_encryptor == None:
+            buffer = self.encrypt(buffer)
+        dropped = None
         with self.write_lock:
+            if flow and self.watermark != None:
+                (sent, dropped) = self.make_room()
+                if not sent:
+                    buffer = None
+            if buffer != None:
+                self.queue_buffer(buffer, encrypt, sequnce_num)
+        if dropped:
+            for sequnce_num in dropped:
+                self.drop_quest(sequnce_num, None, True)
+        return buffer != None
+
+    def queue_buffer(self, buffer, encrypt, sequnce_num):
+        # run with write_lock
+        if encrypt and self.stream_encryptor != None:
+            buffer = self.stream_encryptor.update(buffer)
+        if len(self.out_queue) == 0 and not self.connecting:
+            send = 0
             try:
-                self.out_queue.append(buffer)
-                self.engine.require_write(self)
+                send = self.socket.send(buffer)
+            except (BlockingIOError, InterruptedError):
+                pass
             except:
+                # leave the error to the IO loop, which closes the connection
                 pass
+            if send == len(buffer):
+                return
+            if send > 0:
+                buffer = memoryview(buffer)[send:]
+        try:
+            self.out_queue.append(buffer)
+            self.out_sequnce.append(sequnce_num)
+            self.queued_bytes += len(buffer)
+            if not self.connecting:
+                self.engine.require_write(self)
+        except:
+            pass
+
+    def make_room(self):
+        # run with write_lock, returns whether the new package can be queued and the dropped quests
+        watermark = self.watermark
+        if not watermark.over_high(self.queued_bytes, len(self.out_queue)):
+            return True, None
+        self.write_blocked = True
+
+        if watermark.policy == OverflowPolicy.Block:
+            while self.write_blocked and not self.closed:
+                self.writable.wait()
+            return not self.closed, None
+
+        if watermark.policy == OverflowPolicy.Raise:
+            raise QueueOverflowError("send queue is full")
+
+        if watermark.policy == OverflowPolicy.DropOldest and self.stream_encryptor == None:
+            # the head may be partly written, and bytes of an encrypted stream can never be dropped
+            dropped = []
+            index = 1
+            while index < len(self.out_queue) and watermark.over_high(self.queued_bytes, len(self.out_queue)):
+                sequnce_num = self.out_sequnce[index]
+                if sequnce_num == None:
+                    index += 1
+                    continue
+                self.queued_bytes -= len(self.out_queue[index])
+                del self.out_queue[index]
+                del self.out_sequnce[index]
+                dropped.append(sequnce_num)
+            return not watermark.over_high(self.queued_bytes, len(self.out_queue)), dropped
+
+        return False, None
+
+    def drop_quest(self, sequnce_num, callback, answer_callback):
+        if sequnce_num == None or sequnce_num == 0:
+            return
+        with self.callback_lock:
+            removed = self.callback_map.get(sequnce_num, None)
+            if removed == None or (callback != None and removed is not callback):
+                return
+            del self.callback_map[sequnce_num]
+
+        if answer_callback:
+            answer = Answer()
+            answer.sequnce_num = sequnce_num
+            answer.set_error(FPNN_ERROR.FPNN_EC_CORE_SEND_ERROR.value, 'send queue is full')
+            removed.invoke(self.engine, answer)
+
+    def queue_depth(self):
+        with self.write_lock:
+            return len(self.out_queue), self.queued_bytes
+
+    def is_writable(self):
+        with self.write_lock:
+            if not self.write_blocked and self.watermark != None and self.watermark.over_high(self.queued_bytes, len(self.out_queue)):
+                self.write_blocked = True
+            return not self.write_blocked
 
     def close_callback(self, connection_id, endpoint, caused_by_error):
         if self.connection_callback != None:
             self.connection_callback.closed(connection_id, endpoint, caused_by_error)
 
     def send_answer(self, answer):
-        buffer = answer.raw()
-        if self.connection_info.encrypted:
-            encrypt_buffer = self.encrypt(buffer, True)
-            buffer = struct.pack('<I' + str(len(buffer)) + 's', len(buffer), encrypt_buffer)
-
-        with self.write_lock:
-            try:
-                self.out_queue.append(buffer)
-                self.engine.require_write(self)
-            except:
-                pass
+        self.send_buffer(answer.raw(), self.cipher != None)
+
+    def send_ack(self, sequnce_num):
+        self.send_acks((sequnce_num, ))
+
+    def send_acks(self, sequnce_nums):
+        size = len(EMPTY_ANSWER)
+        frames = bytearray(EMPTY_ANSWER * len(sequnce_nums))
+        for (index, sequnce_num) in enumerate(sequnce_nums):
+            SEQUNCE.pack_into(frames, index * size + EMPTY_ANSWER_SEQUNCE_OFFSET, sequnce_num)
+        if self.cipher != None and self.stream_encryptor == None:
+            # package mode encrypts every answer as a package of its own
+            view = memoryview(frames)
+            frames = b''.join([self.encrypt(view[offset:offset + size]) for offset in range(0, len(frames), size)])
+            self.send_buffer(frames)
+        else:
+            self.send_buffer(frames, self.cipher != None)
 
     def process_io(self, can_read, can_write):
         invalid = False
@@ -142,86 +578,95 @@ class TCPConnection(object):
             invalid = self.write()
 
         if invalid:
-            self.engine.quit_in_loop(self)
-            self.clean_callback()
-            self.engine.thread_pool_execute(self.close_callback, (self.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), True))
-            self.client.notice_closed()
+            self.abort(True)
+
+    def connect_established(self, sock):
+        # run in the IO loop thread, the queued quests are flushed once the socket is registered
+        with self.write_lock:
+            self.socket = sock
+            self.connecting = False
+            self.engine.join_in_loop(self)
+            if len(self.out_queue) > 0:
+                self.engine.require_write(self)
+        self.client.notice_connected(self)
+
+    def connect_failed(self):
+        self.connecting = False
+        self.client.notice_connect_failed(self)
+        self.clean_callback()
+        self.engine.thread_pool_execute(self.client.connect_callback, (self.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), False))
+
+    def cancel_connect(self):
+        if self.racer != None and self.racer.cancel():
+            self.connect_failed()
+            return True
+        return False
+
+    def expire_connect(self):
+        if not self.connecting:
+            return
+        if ClientEngine.error_recorder != None:
+            ClientEngine.error_recorder.record_error("connect timeout")
+        self.cancel_connect()
+
+    def abort(self, in_loop):
+        if in_loop:
+            quit = self.engine.quit_in_loop(self)
+        else:
+            quit = self.engine.quit(self)
+        if not quit:
+            return
+        self.client.notice_closed(self)
+        self.clean_callback()
+        self.engine.thread_pool_execute(self.close_callback, (self.connection_id, self.connection_info.host + ':' + str(self.connection_info.port), True))
 
     def clean_callback(self):
         answer = Answer()
         answer.sequnce_num = 0
         answer.set_error(FPNN_ERROR.FPNN_EC_CORE_CONNECTION_CLOSED.value, 'connection is closed')
         with self.callback_lock:
-            for (socket_fd, callback) in  self.callback_map.items(): 
-                if callback != None:
-                    if callback.sync_semaphore != None:
-                        callback.sync_answer = answer
-                        callback.sync_semaphore.release()
-                    elif callback.callback != None:
-                        self.engine.thread_pool_execute(callback.callback.callback, (answer, ))
+            self.closed = True
+            callbacks = list(self.callback_map.values())
             self.callback_map.clear()
+        for callback in callbacks:
+            if callback != None:
+                callback.invoke(self.engine, answer)
+        with self.write_lock:
+            self.writable.notify_all()
+
+    def expire_quest(self, sequnce_num, callback):
+        with self.callback_lock:
+            if self.callback_map.get(sequnce_num, None) is not callback:
+                return
+            del self.callback_map[sequnce_num]
 
-    def check_timeout(self):
         answer = Answer()
-        answer.sequnce_num = 0
+        answer.sequnce_num = sequnce_num
         answer.set_error(FPNN_ERROR.FPNN_EC_CORE_TIMEOUT.value, 'quest timeout')
-        now = int(round(time.time() * 1000))
+        callback.invoke(self.engine, answer)
+
+    def cancel_quest(self, sequnce_num, callback):
         with self.callback_lock:
-            del_callback_set = set()
-            for (socket_fd, callback) in  self.callback_map.items():
-                if callback != None:
-                    if callback.timeout > 0 and now - callback.create_time >= callback.timeout:
-                        if callback.sync_semaphore != None:
-                            callback.sync_answer = answer
-                            callback.sync_semaphore.release()
-                        elif callback.callback != None:
-                            self.engine.thread_pool_execute(callback.callback.callback, (answer, ))
-                        del_callback_set.add(socket_fd)
-            for s in del_callback_set:
-                del self.callback_map[s]
+            if self.callback_map.get(sequnce_num, None) is callback:
+                del self.callback_map[sequnce_num]
 
     def write(self):
         with self.write_lock:
-            while len(self.out_queue) > 0:
-                buffer = self.out_queue[0]
-                while len(buffer) > 0:
-                    send = 0
-                    try:
-                        send = self.socket.send(buffer)
-                    except socket.error as error:
-                        if error.errno == errno.EAGAIN or error.errno == errno.EWOULDBLOCK:
-                            if send > 0:
-                                buffer = buffer[send:]
-                            self.out_queue[0] = buffer
-                            return False
-                        elif error.errno == errno.EINTR:
-                            if send > 0:
-                                buffer = buffer[send:]
-                            continue
-                        else:
-                            if ClientEngine.error_recorder != None:
-                                ClientEngine.error_recorder.record_error("write socket got error: " + error.errno)
-                            return True
-                    except:
-                        if ClientEngine.error_recorder != None:
-                            ClientEngine.error_recorder.record_error("write socket got exception")
-                        return True
-
-                    if send == len(buffer):
-                        self.out_queue.pop(0)
-
-                    buffer = buffer[send:]
-
-            self.engine.release_write(self)
-            return False
-
-    def read(self):
-        while True:
-            buffer = None
+            invalid = self.flush()
+            if self.write_blocked and (self.watermark == None or self.watermark.under_low(self.queued_bytes, len(self.out_queue))):
+                self.write_blocked = False
+                self.writable.notify_all()
+                self.engine.thread_pool_execute(self.client.notice_writable, (self, ))
+            return invalid
+
+    def flush(self):
+        # run with write_lock
+        while len(self.out_queue) > 0:
             try:
-                buffer = self.socket.recv(self.need_read_lenth)
-                if len(buffer) == 0:
-                    return True
+                if len(self.out_queue) > 1 and hasattr(self.socket, 'sendmsg'):
+                    send = self.socket.sendmsg(itertools.islice(self.out_queue, WRITE_IOV_MAX))
+                else:
+                    send = self.socket.send(self.out_queue[0])
             except socket.error as error:
                 if error.errno == errno.EAGAIN or error.errno == errno.EWOULDBLOCK:
                     return False
@@ -229,97 +674,59 @@ class TCPConnection(object):
                     continue
                 else:
                     if ClientEngine.error_recorder != None:
-                        ClientEngine.error_recorder.record_error("read socket got error: " + error.errno)
+                        ClientEngine.error_recorder.record_error("write socket got error: " + str(error.errno))
                     return True
             except:
                 if ClientEngine.error_recorder != None:
                     ClientEngine.error_recorder.record_error("write socket got exception")
                 return True
 
-            if buffer != None and len(buffer) > 0:
-                self.check_read_finish(buffer)
+            self.queued_bytes -= send
+            while len(self.out_queue) > 0 and send >= len(self.out_queue[0]):
+                send -= len(self.out_queue.popleft())
+                self.out_sequnce.popleft()
+            if send > 0:
+                self.out_queue[0] = memoryview(self.out_queue[0])[send:]
+                return False
 
-    def check_read_finish(self, buffer):
-        for s in buffer:
-            self.in_buffer.append(s)
+        self.engine.release_write(self)
+        return False
 
-        if len(buffer) < self.need_read_lenth:
-            self.need_read_lenth -= len(buffer)
-            return
-
-        if self.read_step == ReadPackageStep.READ_HEADER_NO_ENCRYPTOR:
-            arr = struct.unpack('<4sBBBBI', self.in_buffer)
-            self.read_package.mtype = arr[3]
-            self.read_package.ss = arr[4]
-            self.read_package.psize = arr[5]
-            self.read_step = ReadPackageStep.READ_LEFT_NO_ENCRYPTOR
-            if self.read_package.mtype == FpnnMType.FPNN_MT_ONEWAY.value:
-                self.need_read_lenth = self.read_package.ss + self.read_package.psize
-            elif self.read_package.mtype == FpnnMType.FPNN_MT_TWOWAY.value:
-                self.need_read_lenth = self.read_package.ss + self.read_package.psize + 4
-            else:
-                self.need_read_lenth = self.read_package.psize + 4
-            self.in_buffer = bytearray(0)
-            return
-                
-        if self.read_step == ReadPackageStep.READ_LEFT_NO_ENCRYPTOR:
-            if self.read_package.mtype == FpnnMType.FPNN_MT_ONEWAY.value:
-                arr = struct.unpack('<' + str(self.read_package.ss) + 's' + str(self.read_package.psize) + 's', self.in_buffer)
-                self.read_package.method = arr[0]
-                self.read_package.payload = arr[1]
-            elif self.read_package.mtype == FpnnMType.FPNN_MT_TWOWAY.value:
-                arr = struct.unpack('<I' + str(self.read_package.ss) + 's' + str(self.read_package.psize) + 's', self.in_buffer)
-                self.read_package.sequnce_num = arr[0]
-                self.read_package.method = arr[1]
-                self.read_package.payload = arr[2]
-            else:
-                arr = struct.unpack('<I' + str(self.read_package.psize) + 's', self.in_buffer)
-                self.read_package.sequnce_num = arr[0]
-                self.read_package.payload = arr[1]
-
-            self.read_step = ReadPackageStep.READ_HEADER_NO_ENCRYPTOR
-            self.need_read_lenth = 12
-            self.handle_package(self.read_package)
-            self.read_package.reset()
-            self.in_buffer = bytearray(0)
-            return
+    def read(self):
+        # acks of inline handled quests are collected during the read burst and written at once
+        self.ack_batch = []
+        try:
+            return self.read_packages()
+        finally:
+            batch = self.ack_batch
+            self.ack_batch = None
+            if len(batch) > 0:
+                self.send_acks(batch)
+
+    def read_packages(self):
+        while True:
+            buffer = self.package_reader.get_buffer()
+            try:
+                count = self.socket.recv_into(buffer)
+                if count == 0:
+                    return True
+            except socket.error as error:
+                if error.errno == errno.EAGAIN or error.errno == errno.EWOULDBLOCK:
+                    return False
+                elif error.errno == errno.EINTR:
+                    continue
+                else:
+                    if ClientEngine.error_recorder != None:
+                        ClientEngine.error_recorder.record_error("read socket got error: " + str(error.errno))
+                    return True
+            except:
+                if ClientEngine.error_recorder != None:
+                    ClientEngine.error_recorder.record_error("read socket got exception")
+                return True
 
-        if self.read_step == ReadPackageStep.READ_HEADER_ENCRYPTOR:
-            arr = struct.unpack('<I', self.in_buffer)
-            self.read_step = ReadPackageStep.READ_LEFT_ENCRYPTOR
-            self.need_read_lenth = arr[0]
-            self.in_buffer = bytearray(0)
-            return
-        
-        if self.read_step == ReadPackageStep.READ_LEFT_ENCRYPTOR:
-            self.in_buffer = self.encrypt(self.in_buffer, False)
-            buffer = self.in_buffer[0:12]
-            arr = struct.unpack('<4sBBBBI', buffer)
-            self.read_package.mtype = arr[3]
-            self.read_package.ss = arr[4]
-            self.read_package.psize = arr[5]
-            self.in_buffer = self.in_buffer[12:]
-
-            if self.read_package.mtype == FpnnMType.FPNN_MT_ONEWAY.value:
-                arr = struct.unpack('<' + str(self.read_package.ss) + 's' + str(self.read_package.psize) + 's', self.in_buffer)
-                self.read_package.method = arr[0]
-                self.read_package.payload = arr[1]
-            elif self.read_package.mtype == FpnnMType.FPNN_MT_TWOWAY.value:
-                arr = struct.unpack('<I' + str(self.read_package.ss) + 's' + str(self.read_package.psize) + 's', self.in_buffer)
-                self.read_package.sequnce_num = arr[0]
-                self.read_package.method = arr[1]
-                self.read_package.payload = arr[2]
-            else:
-                arr = struct.unpack('<I' + str(self.read_package.psize) + 's', self.in_buffer)
-                self.read_package.sequnce_num = arr[0]
-                self.read_package.payload = arr[1]
-
-            self.read_step = ReadPackageStep.READ_HEADER_ENCRYPTOR
-            self.need_read_lenth = 4
-            self.handle_package(self.read_package)
-            self.read_package.reset()
-            self.in_buffer = bytearray(0)
-            return
+            self.package_reader.buffer_updated(count)
+            if count < len(buffer):
+                return False
 
     def process_quest(self, obj, quest):
         processor_connection_info = ProcessorConnectionInfo(self, quest)
@@ -331,18 +738,35 @@ class TCPConnection(object):
             if ClientEngine.error_recorder != None:
                 ClientEngine.error_recorder.record_error(str(ex))
 
-    def unpack_fix_bin(self, payload):
+    def execute_quest(self, method, quest, fn, args):
+        lanes = self.client.lanes
+        if lanes != None:
+            key = self.processor.dispatch_key(method, quest)
+            if key != None:
+                lanes.run(key, fn, args)
+                return
+        self.engine.thread_pool_execute(fn, args)
+
+    def process_inline(self, handler, package):
+        if package.mtype == FpnnMType.FPNN_MT_TWOWAY.value:
+            if self.ack_batch != None:
+                self.ack_batch.append(package.sequnce_num)
+            else:
+                self.send_ack(package.sequnce_num)
         try:
-            data = msgpack.unpackb(payload)
-            return data
-        except UnicodeDecodeError:
-            data = msgpack.unpackb(payload, raw = True)
-            fixBinData = {}
-            for (key, value) in data.items():
-                fixBinData[str(key, encoding = "utf8")] = value
-            return fixBinData
+            handler(unpack_fix_bin(package.payload))
+        except Exception as ex:
+            if ClientEngine.error_recorder != None:
+                ClientEngine.error_recorder.record_error("inline handler got exception: " + str(ex))
 
     def handle_package(self, package):
+        if package.mtype != FpnnMType.FPNN_MT_ANSWER.value and package.payload != None:
+            table = self.client.inline_table
+            if table != None:
+                handler = table.get(package.method, None)
+                if handler != None:
+                    self.process_inline(handler, package)
+                    return
         if package.mtype == FpnnMType.FPNN_MT_ONEWAY.value:
             if self.processor == None:
                 return
@@ -351,11 +775,9 @@ class TCPConnection(object):
             method = package.method.decode('utf-8')
             if not hasattr(self.processor, method):
                 return
-            quest = Quest(package.method, True)
-            quest.sequnce_num = package.sequnce_num
-            quest.params_map = self.unpack_fix_bin(package.payload)
+            quest = decode_quest(package)
             obj = getattr(self.processor, method)
-            self.engine.thread_pool_execute(obj, (ProcessorConnectionInfo(self, quest), quest))
+            self.execute_quest(method, quest, obj, (ProcessorConnectionInfo(self, quest), quest))
         elif package.mtype == FpnnMType.FPNN_MT_TWOWAY.value:
             if self.processor == None:
                 return
@@ -364,11 +786,9 @@ class TCPConnection(object):
             method = package.method.decode('utf-8')
             if not hasattr(self.processor, method):
                 return
-            quest = Quest(package.method)
-            quest.sequnce_num = package.sequnce_num
-            quest.params_map = self.unpack_fix_bin(package.payload)
+            quest = decode_quest(package)
             obj = getattr(self.processor, method)
-            self.engine.thread_pool_execute(self.process_quest, (obj, quest))
+            self.execute_quest(method, quest, self.process_quest, (obj, quest))
         elif package.mtype == FpnnMType.FPNN_MT_ANSWER.value:
             callback = None
             with self.callback_lock:
@@ -376,17 +796,5 @@ class TCPConnection(object):
                 if callback != None:
                     del self.callback_map[package.sequnce_num]
 
-            answer = Answer()
-            answer.sequnce_num = package.sequnce_num
-            data = self.unpack_fix_bin(package.payload)
-            if package.ss == 0:
-                answer.set_params(data)
-            else:
-                answer.set_error(data.get("code", FPNN_ERROR.FPNN_EC_PROTO_UNKNOWN_ERROR.value), data.get("ex", "unknown error"))
-
             if callback != None:
-                if callback.sync_semaphore != None:
-                    callback.sync_answer = answer
-                    callback.sync_semaphore.release()
-                elif callback.callback != None:
-                    self.engine.thread_pool_execute(callback.callback.callback, (answer, ))
+                callback.invoke(self.engine, decode_answer(package, callback.lazy_answer()))
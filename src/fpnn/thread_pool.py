@@ -1,89 +1,260 @@
-import sys
-if sys.version > '3':
-    import queue
-else:
-    import Queue as queue
+#encoding=utf8
+
 import os
-import threading
-import contextlib
 import time
+import threading
+from collections import deque
+from .flow_control import *
 
-StopEvent = object()
+__all__ = ('ThreadPool', 'SerialLanes')
+
+DEFAULT_IDLE_TIMEOUT = 60
+DEFAULT_LANE_BATCH = 16
 
 class ThreadPool(object):
-    def __init__(self, max_num = None, max_task_num = None):
-        if max_task_num:
-            self.q = queue.Queue(max_task_num)
-        else:
-            self.q = queue.Queue()
+    def __init__(self, max_num = None, max_task_num = None, min_num = 0, idle_timeout = DEFAULT_IDLE_TIMEOUT, policy = OverflowPolicy.Block):
+        if not isinstance(policy, OverflowPolicy):
+            raise Exception("policy type error")
         if max_num == None:
-            max_num = (os.cpu_count() or 1) * 5
+            max_num = min(32, (os.cpu_count() or 1) + 4)
+        if max_num < 1:
+            raise Exception("max thread num must be greater than 0")
         self.max_num = max_num
+        self.min_num = max(0, min(min_num, max_num))
+        # 0 or None keeps the task queue unbounded
+        self.max_task_num = max_task_num or 0
+        self.idle_timeout = idle_timeout
+        self.policy = policy
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.tasks = deque()
         self.cancel = False
         self.terminal = False
-        self.generate_list = []
-        self.free_list = []
+        self.thread_count = 0
+        self.idle_count = 0
+        self.worker_start = {}
+        self.reset_metrics()
+        with self.lock:
+            for i in range(self.min_num):
+                self.generate_thread()
 
-    def run(self, func, args, callback=None):
-        if self.cancel:
-            return
-        if len(self.free_list) == 0 and len(self.generate_list) < self.max_num:
-            self.generate_thread()
-        w = (func, args, callback,)
-        self.q.put(w)
+    def run(self, func, args, callback = None, bounded = True):
+        # bounded = False is for work the engine submits from its IO thread, it is queued
+        # past max_task_num and never blocked, dropped or refused by the overflow policy
+        with self.lock:
+            if self.cancel:
+                return False
+            if bounded and self.max_task_num > 0 and len(self.tasks) >= self.max_task_num:
+                if self.policy == OverflowPolicy.Block:
+                    while not self.cancel and len(self.tasks) >= self.max_task_num:
+                        self.not_full.wait()
+                    if self.cancel:
+                        return False
+                elif self.policy == OverflowPolicy.DropOldest:
+                    if not self.drop_oldest():
+                        self.dropped += 1
+                        return False
+                elif self.policy == OverflowPolicy.DropNewest:
+                    self.dropped += 1
+                    return False
+                else:
+                    self.dropped += 1
+                    raise QueueOverflowError("thread pool task queue is full")
 
-    def generate_thread(self):
-        t = threading.Thread(target=self.call)
-        t.start()
+            self.tasks.append((func, args, callback, time.monotonic(), bounded))
+            self.submitted += 1
+            if self.idle_count < len(self.tasks) and self.thread_count < self.max_num:
+                self.generate_thread()
+            self.not_empty.notify()
+            return True
 
-    def call(self):
-        current_thread = threading.currentThread()
-        self.generate_list.append(current_thread)
+    def drop_oldest(self):
+        # called with the lock held, only bounded tasks can be dropped
+        for (index, task) in enumerate(self.tasks):
+            if task[4]:
+                del self.tasks[index]
+                self.dropped += 1
+                return True
+        return False
 
-        event = self.q.get()
-        while event != StopEvent:
+    def generate_thread(self):
+        # called with the lock held, the thread counts as idle until it takes a task
+        self.thread_count += 1
+        self.idle_count += 1
+        self.peak_thread_count = max(self.peak_thread_count, self.thread_count)
+        t = threading.Thread(target = self.call)
+        t.daemon = True
+        try:
+            t.start()
+        except:
+            self.thread_count -= 1
+            self.idle_count -= 1
+            raise
 
-            func, arguments, callback = event
-            try:
-                result = func(*arguments)
+    def call(self):
+        ident = threading.get_ident()
+        with self.lock:
+            self.worker_start[ident] = time.monotonic()
+        try:
+            while True:
+                task = self.next_task()
+                if task == None:
+                    return
+                (func, args, callback) = task
+                start = time.monotonic()
                 success = True
-            except Exception as e:
-                success = False
                 result = None
-
-            if callback is not None:
                 try:
-                    callback(success, result)
-                except Exception as e:
-                    pass
+                    result = func(*args)
+                except:
+                    success = False
 
-            with self.worker_state(self.free_list, current_thread):
-                if self.terminal:
-                    event = StopEvent
-                else:
-                    event = self.q.get()
-        else:
-            self.generate_list.remove(current_thread)
+                if callback is not None:
+                    try:
+                        callback(success, result)
+                    except:
+                        pass
+
+                cost = time.monotonic() - start
+                with self.lock:
+                    self.idle_count += 1
+                    self.completed += 1
+                    if not success:
+                        self.failed += 1
+                    self.busy_time += cost
+        finally:
+            with self.lock:
+                self.worker_time += time.monotonic() - max(self.worker_start.pop(ident), self.metrics_start)
+
+    def next_task(self):
+        # the worker leaves the idle count on taking a task, or leaves the pool on None
+        with self.lock:
+            while len(self.tasks) == 0 and not self.terminal:
+                if self.cancel:
+                    break
+                if not self.not_empty.wait(self.idle_timeout) and len(self.tasks) == 0 and self.thread_count > self.min_num:
+                    break
+            self.idle_count -= 1
+            if len(self.tasks) == 0 or self.terminal:
+                self.thread_count -= 1
+                return None
+            (func, args, callback, queued, bounded) = self.tasks.popleft()
+            if self.max_task_num > 0:
+                self.not_full.notify()
+            wait = time.monotonic() - queued
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+            self.dequeued += 1
+            return (func, args, callback)
 
     def close(self):
-        self.cancel = True
-        full_size = len(self.generate_list) + 1
-        while full_size:
-            self.q.put(StopEvent)
-            full_size -= 1
+        # queued tasks are still run, then the workers exit
+        with self.lock:
+            self.cancel = True
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
 
     def terminate(self):
-        self.terminal = True
+        with self.lock:
+            self.cancel = True
+            self.terminal = True
+            self.dropped += len(self.tasks)
+            self.tasks.clear()
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def reset_metrics(self):
+        with self.lock:
+            now = time.monotonic()
+            self.metrics_start = now
+            self.submitted = 0
+            self.dequeued = 0
+            self.completed = 0
+            self.failed = 0
+            self.dropped = 0
+            self.wait_time = 0
+            self.max_wait_time = 0
+            self.busy_time = 0
+            self.worker_time = 0
+            self.peak_thread_count = self.thread_count
 
-        while self.generate_list:
-            self.q.put(StopEvent)
+    def metrics(self):
+        # counters and times since the last reset_metrics(), utilization is busy time over worker lifetime
+        with self.lock:
+            now = time.monotonic()
+            worker_time = self.worker_time + sum(now - max(start, self.metrics_start) for start in self.worker_start.values())
+            return {
+                'threads': self.thread_count,
+                'idle_threads': self.idle_count,
+                'peak_threads': self.peak_thread_count,
+                'queued': len(self.tasks),
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'avg_wait_ms': self.wait_time * 1000 / self.dequeued if self.dequeued > 0 else 0,
+                'max_wait_ms': self.max_wait_time * 1000,
+                'utilization': min(1.0, self.busy_time / worker_time) if worker_time > 0 else 0,
+                'elapsed': now - self.metrics_start,
+            }
 
-        self.q.queue.clear()
+class SerialLane(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tasks = deque()
+        self.running = False
+        self.retired = False
 
-    @contextlib.contextmanager
-    def worker_state(self, state_list, worker_thread):
-        state_list.append(worker_thread)
+class SerialLanes(object):
+    # tasks of one key run one after another in submit order, different keys run in parallel on the executor.
+    # every lane has its own lock, an idle lane is retired and dropped from the map.
+    # execute must run every task it accepts, a lane whose drain is lost stays running and never delivers again,
+    # so pass an executor that never drops like the engine's thread_pool_execute
+    def __init__(self, execute, batch = DEFAULT_LANE_BATCH):
+        self.execute = execute
+        self.batch = batch
+        self.lanes = {}
+
+    def run(self, key, func, args):
+        while True:
+            lane = self.lanes.get(key, None)
+            if lane == None:
+                lane = self.lanes.setdefault(key, SerialLane())
+            with lane.lock:
+                if lane.retired:
+                    continue
+                lane.tasks.append((func, args))
+                if lane.running:
+                    return
+                lane.running = True
+            break
+        self.schedule(key, lane)
+
+    def schedule(self, key, lane):
+        scheduled = False
         try:
-            yield
+            scheduled = self.execute(self.drain, (key, lane)) != False
         finally:
-            state_list.remove(worker_thread)
+            if not scheduled:
+                with lane.lock:
+                    lane.running = False
+
+    def drain(self, key, lane):
+        for i in range(self.batch):
+            with lane.lock:
+                if len(lane.tasks) == 0:
+                    lane.running = False
+                    lane.retired = True
+                    self.lanes.pop(key, None)
+                    return
+                (func, args) = lane.tasks.popleft()
+            try:
+                func(*args)
+            except:
+                pass
+        # give the worker back to the other lanes, this lane stays running
+        self.schedule(key, lane)
+
+    def lane_count(self):
+        return len(self.lanes)
@@ -2,3 +2,6 @@ from rtvt.rtvt_server_client import *
 from rtvt.rtvt_quest_processor import *
 from rtvt. rtvt_quest_processor_internal import *
 from rtvt. rtvt_quest_processor_internal_fpnn import *
+from rtvt.rtvt_async_client import *
+from rtvt.rtvt_voice_encoder import *
+from rtvt.rtvt_result_coalescer import *
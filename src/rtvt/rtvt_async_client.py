@@ -0,0 +1,208 @@
+#encoding=utf8
+
+import sys
+sys.path.append("..")
+import time
+import asyncio
+from fpnn import *
+from .rtvt_voice_buffer import *
+from .rtvt_voice_encoder import *
+
+__all__ = ('RTVTResult', 'AsyncRTVTStream', 'AsyncRTVTClient')
+
+class RTVTResult(object):
+    RECOGNIZED_RESULT = 'recognized_result'
+    RECOGNIZED_TEMP_RESULT = 'recognized_temp_result'
+    TRANSLATED_RESULT = 'translated_result'
+    TRANSLATED_TEMP_RESULT = 'translated_temp_result'
+
+    def __init__(self, kind, data):
+        self.kind = kind
+        self.data = data
+
+    def is_temp(self):
+        return self.kind == RTVTResult.RECOGNIZED_TEMP_RESULT or self.kind == RTVTResult.TRANSLATED_TEMP_RESULT
+
+    def __str__(self):
+        return 'RTVTResult: {0} {1}'.format(self.kind, str(self.data))
+
+class AsyncRTVTStream(object):
+    def __init__(self, stream_id):
+        self.stream_id = stream_id
+        self.results = asyncio.Queue()
+        self.voice_buffer = VoiceRingBuffer()
+        self.encoder = VoiceFrameEncoder(stream_id)
+        self.seq = 1
+        self.closed = False
+
+    def put_result(self, result):
+        if not self.closed:
+            self.results.put_nowait(result)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.results.put_nowait(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed and self.results.empty():
+            raise StopAsyncIteration
+        result = await self.results.get()
+        if result == None:
+            raise StopAsyncIteration
+        return result
+
+class AsyncRTVTQuestProcessor(QuestProcessor):
+    def __init__(self, client):
+        QuestProcessor.__init__(self)
+        self.client = client
+
+    def push_result(self, connection, quest, kind):
+        connection.send_answer(Answer())
+        # final results often arrive after voiceEnd, pushes of unknown or closed streams are dropped
+        stream = self.client.get_stream(quest.params_map.get('streamId', None))
+        if stream != None:
+            stream.put_result(RTVTResult(kind, quest.params_map))
+
+    def recognizedResult(self, connection, quest):
+        self.push_result(connection, quest, RTVTResult.RECOGNIZED_RESULT)
+
+    def recognizedTempResult(self, connection, quest):
+        self.push_result(connection, quest, RTVTResult.RECOGNIZED_TEMP_RESULT)
+
+    def translatedResult(self, connection, quest):
+        self.push_result(connection, quest, RTVTResult.TRANSLATED_RESULT)
+
+    def translatedTempResult(self, connection, quest):
+        self.push_result(connection, quest, RTVTResult.TRANSLATED_TEMP_RESULT)
+
+class AsyncRTVTClient(object):
+    def __init__(self, endpoint, pid, uid, loop = None):
+        arr = endpoint.split(":")
+        self.client = AsyncTCPClient(arr[0], int(arr[1]), True, loop)
+        self.client.set_quest_timeout(5000)
+        self.client.set_connect_timeout(1000)
+        self.client.set_quest_processor(AsyncRTVTQuestProcessor(self))
+        self.endpoint = endpoint
+        self.pid = pid
+        self.uid = uid
+        self.streams = {}
+
+    def set_quest_timeout(self, timeout):
+        self.client.set_quest_timeout(timeout * 1000)
+
+    def set_connect_timeout(self, timeout):
+        self.client.set_connect_timeout(timeout * 1000)
+
+    def set_connection_callback(self, callback):
+        self.client.set_connection_callback(callback)
+
+    def get_stream(self, streamId, create = False):
+        stream = self.streams.get(streamId, None)
+        if stream == None and create and streamId != None:
+            stream = AsyncRTVTStream(streamId)
+            self.streams[streamId] = stream
+        return stream
+
+    def close(self):
+        self.client.close()
+
+    def destory(self):
+        for stream in self.streams.values():
+            stream.close()
+        self.streams.clear()
+        self.client.destory()
+
+    async def login(self, token, ts):
+        quest = Quest("login")
+        quest.param("pid", self.pid)
+        quest.param("token", token)
+        quest.param("ts", ts)
+        quest.param("uid", self.uid)
+        quest.param("version", "rtvt_python_sdk")
+
+        answer = await self.client.send_quest(quest)
+
+        if answer.is_error():
+            return False, answer.error_code
+        else:
+            try:
+                successed = answer.want("successed")
+                return successed == True, 0
+            except:
+                return False, 10001
+
+    async def create_stream(self, srcLang, destLang, needAsrResult, needTempResult, needTransResult, srcAltLanguage = []):
+        quest = Quest("voiceStart")
+        quest.param("asrResult", needAsrResult)
+        quest.param("asrTempResult", needTempResult)
+        quest.param("transResult", needTransResult)
+        quest.param("srcLanguage", srcLang)
+        quest.param("destLanguage", destLang)
+
+        if len(srcAltLanguage) > 0:
+            quest.param("srcAltLanguage", srcAltLanguage)
+
+        answer = await self.client.send_quest(quest)
+
+        if answer.is_error():
+            return -1, answer.error_code
+        else:
+            try:
+                streamId = answer.want("streamId")
+                self.get_stream(streamId, True)
+                return streamId, 0
+            except:
+                return -1, 10001
+
+    async def close_stream(self, streamId):
+        quest = Quest("voiceEnd")
+        quest.param("streamId", streamId)
+
+        answer = await self.client.send_quest(quest)
+
+        if answer.is_error():
+            return answer.error_code
+        else:
+            stream = self.streams.pop(streamId, None)
+            if stream != None:
+                stream.close()
+            return 0
+
+    def results(self, streamId):
+        stream = self.get_stream(streamId)
+        if stream == None:
+            raise ValueError("unknown stream: " + str(streamId))
+        return stream
+
+    def voice_quest(self, streamId, seq, data):
+        stream = self.get_stream(streamId)
+        encoder = stream.encoder if stream != None else VoiceFrameEncoder(streamId)
+        return encoder.quest(seq, data, int(time.time() * 1000))
+
+    async def send_voice(self, streamId, seq, data):
+        answer = await self.client.send_quest(self.voice_quest(streamId, seq, data))
+
+        if answer.is_error():
+            return answer.error_code
+        else:
+            return 0
+
+    def send_voice_async(self, streamId, seq, data):
+        self.client.send_quest_nowait(self.voice_quest(streamId, seq, data))
+        return 0
+
+    def send_voice_variable(self, streamId, data):
+        if isinstance(data, (bytes, bytearray)):
+            stream = self.get_stream(streamId)
+            if stream != None:
+                stream.voice_buffer.extend(data)
+                for frame in stream.voice_buffer.pop_frames():
+                    self.send_voice_async(streamId, stream.seq, frame)
+                    stream.seq += 1
+            return 0
+        else:
+            raise ValueError("data must be bytes or bytearray.")
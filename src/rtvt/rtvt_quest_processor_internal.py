@@ -9,35 +9,61 @@ class RTVTQuestProcessorInternal(QuestProcessor):
     def __init__(self):
         QuestProcessor.__init__(self)
         self.processor = None
+        self.client = None
+        self.coalescer = None
 
     def set_processor(self, processor):
         self.processor = processor
 
+    def dispatch_key(self, method, quest):
+        return quest.params_map.get("streamId", None)
+
+    def map_params(self, params):
+        if self.client != None:
+            return self.client.map_result_stream(params)
+        return params
+
+    def inline_handlers(self):
+        if self.processor == None:
+            return {}
+        return {
+            "recognizedResult": self.inline_handler("recognizedResult", self.processor.recognized_result),
+            "recognizedTempResult": self.inline_handler("recognizedTempResult", self.processor.recognized_temp_result),
+            "translatedResult": self.inline_handler("translatedResult", self.processor.translated_result),
+            "translatedTempResult": self.inline_handler("translatedTempResult", self.processor.translated_temp_result),
+        }
+
+    def inline_handler(self, method, fn):
+        def handler(params):
+            self.deliver(method, fn, params)
+        return handler
+
+    def deliver(self, method, fn, params):
+        data = self.map_params(params)
+        coalescer = self.coalescer
+        if coalescer == None:
+            try:
+                fn(data)
+            except:
+                pass
+            return
+        key = None
+        if method.endswith("TempResult"):
+            key = (method, data.get("lang", None), data.get("taskId", None))
+        coalescer.deliver(data.get("streamId", None), key, fn, data)
+
     def recognizedResult(self, connection, quest):
-        connection.send_answer(Answer())
-        try:
-            self.processor.recognized_result(quest.params_map)
-        except:
-            pass
+        connection.send_ack()
+        self.deliver("recognizedResult", self.processor.recognized_result, quest.params_map)
 
     def recognizedTempResult(self, connection, quest):
-        connection.send_answer(Answer())
-        try:
-            self.processor.recognized_temp_result(quest.params_map)
-        except:
-            pass
-    
+        connection.send_ack()
+        self.deliver("recognizedTempResult", self.processor.recognized_temp_result, quest.params_map)
+
     def translatedResult(self, connection, quest):
-        connection.send_answer(Answer())
-        try:
-            self.processor.translated_result(quest.params_map)
-        except:
-            pass
-    
-    def translatedTempResult(self, connection, quest):
-        connection.send_answer(Answer())
-        try:
-            self.processor.translated_temp_result(quest.params_map)
-        except:
-            pass
+        connection.send_ack()
+        self.deliver("translatedResult", self.processor.translated_result, quest.params_map)
 
+    def translatedTempResult(self, connection, quest):
+        connection.send_ack()
+        self.deliver("translatedTempResult", self.processor.translated_temp_result, quest.params_map)
@@ -0,0 +1,82 @@
+#encoding=utf8
+
+import threading
+from collections import deque
+
+__all__ = ('RTVTResultCoalescer', )
+
+class CoalescedResult(object):
+    def __init__(self, fn, data, key):
+        self.fn = fn
+        self.data = data
+        self.key = key
+
+class CoalescedStream(object):
+    def __init__(self):
+        self.pending = deque()
+        self.temp = {}
+        self.draining = False
+
+class RTVTResultCoalescer(object):
+    # results of a stream are delivered one after another on the executor. while the monitor is busy a newer
+    # temp result replaces the pending one with the same key and moves to the end, final results are never replaced.
+    # like SerialLanes, execute must never drop a drain it has accepted
+    def __init__(self, execute):
+        self.execute = execute
+        self.lock = threading.Lock()
+        self.streams = {}
+        self.coalesced = 0
+        self.stream_coalesced = {}
+
+    def deliver(self, streamId, key, fn, data):
+        # key is None for final results
+        result = CoalescedResult(fn, data, key)
+        with self.lock:
+            state = self.streams.get(streamId, None)
+            if state == None:
+                state = CoalescedStream()
+                self.streams[streamId] = state
+            if key != None:
+                older = state.temp.get(key, None)
+                if older != None:
+                    state.pending.remove(older)
+                    self.coalesced += 1
+                    self.stream_coalesced[streamId] = self.stream_coalesced.get(streamId, 0) + 1
+                state.temp[key] = result
+            state.pending.append(result)
+            if state.draining:
+                return
+            state.draining = True
+        scheduled = False
+        try:
+            scheduled = self.execute(self.drain, (streamId, state)) != False
+        finally:
+            if not scheduled:
+                with self.lock:
+                    state.draining = False
+
+    def drain(self, streamId, state):
+        while True:
+            with self.lock:
+                if len(state.pending) == 0:
+                    state.draining = False
+                    if self.streams.get(streamId, None) is state:
+                        del self.streams[streamId]
+                    return
+                result = state.pending.popleft()
+                if result.key != None and state.temp.get(result.key, None) is result:
+                    del state.temp[result.key]
+            try:
+                result.fn(result.data)
+            except:
+                pass
+
+    def coalesced_count(self, streamId = None):
+        with self.lock:
+            if streamId == None:
+                return self.coalesced
+            return self.stream_coalesced.get(streamId, 0)
+
+    def remove_stream(self, streamId):
+        with self.lock:
+            self.stream_coalesced.pop(streamId, None)
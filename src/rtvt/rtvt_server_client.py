@@ -4,22 +4,103 @@ import sys
 sys.path.append("..")
 import threading
 import hashlib
-from collections import deque
 from fpnn.tcp_client import *
+from fpnn.client_engine import ShardedClientEngine
+from fpnn.flow_control import *
+from fpnn.fpnn_error import *
 from fpnn.fpnn_client import *
 from fpnn.quest import *
 from .rtvt_quest_processor_internal import *
 from .rtvt_quest_processor_internal_fpnn import *
+from .rtvt_voice_buffer import *
+from .rtvt_voice_encoder import *
+from .rtvt_result_coalescer import *
+from collections import deque
+
+RESUME_RETRY_INTERVAL = 1000
+
+# errors of the connection itself, any other error is the server refusing the quest
+TRANSPORT_ERRORS = frozenset((
+    FPNN_ERROR.FPNN_EC_CORE_CONNECTION_CLOSED.value,
+    FPNN_ERROR.FPNN_EC_CORE_INVALID_CONNECTION.value,
+    FPNN_ERROR.FPNN_EC_CORE_TIMEOUT.value,
+    FPNN_ERROR.FPNN_EC_CORE_SEND_ERROR.value,
+    FPNN_ERROR.FPNN_EC_CORE_SERVER_STOPPING.value,
+))
+
+def is_transport_error(code):
+    return code in TRANSPORT_ERRORS
+
+class RTVTConnectionCallback(ConnectionCallback):
+    def __init__(self, client):
+        self.client = client
+
+    def connected(self, connection_id, endpoint, connected):
+        self.client.wake_streams()
+        if self.client.connection_callback != None:
+            self.client.connection_callback.connected(connection_id, endpoint, connected)
+
+    def closed(self, connection_id, endpoint, caused_by_error):
+        # the next connection may never get blocked, so writable would not fire for the held frames
+        self.client.wake_streams()
+        if self.client.connection_callback != None:
+            self.client.connection_callback.closed(connection_id, endpoint, caused_by_error)
+        if caused_by_error and self.client.resume_enabled:
+            self.client.resume()
+
+    def writable(self, connection_id, endpoint):
+        self.client.flush_streams()
+        if self.client.connection_callback != None:
+            self.client.connection_callback.writable(connection_id, endpoint)
+
+class RTVTResumeLoginCallback(QuestCallback):
+    def __init__(self, client):
+        self.client = client
+
+    def callback(self, answer):
+        if answer.is_error():
+            self.client.resume_login_done(False, is_transport_error(answer.error_code))
+        else:
+            self.client.resume_login_done(answer.get("successed", False) == True, False)
+
+class RTVTResumeStreamCallback(QuestCallback):
+    def __init__(self, client, streamId):
+        self.client = client
+        self.streamId = streamId
+
+    def callback(self, answer):
+        serverStreamId = None
+        if not answer.is_error():
+            serverStreamId = answer.get("streamId", None)
+        self.client.resume_stream_done(self.streamId, serverStreamId)
+
+class RTVTCheckpointCallback(QuestCallback):
+    need_answer_body = False
+
+    def __init__(self, client, streamId, seq):
+        self.client = client
+        self.streamId = streamId
+        self.seq = seq
+
+    def callback(self, answer):
+        if not answer.is_error():
+            self.client.notice_acked(self.streamId, self.seq)
+
+class RTVTNoopCallback(QuestCallback):
+    need_answer_body = False
+
+RTVT_NOOP_CALLBACK = RTVTNoopCallback()
 
 class RTVTClient(object):
 
-    def __init__(self, endpoint, pid, uid):
+    def __init__(self, endpoint, pid, uid, shared_engine = False, resume = False, replay_frames = 25):
         arr = endpoint.split(":")
 
         if sys.platform == 'win32':
             self.client = FPNNTCPClient(arr[0], int(arr[1]), True, 5)
         else:
-            self.client = TCPClient(arr[0], int(arr[1]))
+            engine = ShardedClientEngine.shared() if shared_engine else None
+            self.client = TCPClient(arr[0], int(arr[1]), True, engine)
             self.client.set_quest_timeout(5000)
             self.client.set_connect_timeout(1000)
 
@@ -31,6 +112,31 @@ class RTVTClient(object):
         self.stream_lock = threading.Lock()
         self.stream_queue = {}
         self.stream_seq_map = {}
+        self.stream_ack_interval = {}
+        self.stream_acked_seq = {}
+        self.voice_encoders = {}
+        self.result_coalescer = None
+        self.connection_callback = None
+        # resumption keeps the stream id returned by create_stream stable for the application,
+        # server_stream_map/app_stream_map translate it to the stream id of the current session
+        self.resume_enabled = resume and sys.platform != 'win32'
+        self.replay_frames = replay_frames
+        self.login_params = None
+        self.resuming = 0
+        self.resume_retrying = False
+        self.stream_params = {}
+        self.stream_tail = {}
+        self.server_stream_map = {}
+        self.app_stream_map = {}
+        # frames wait in stream_pending while the connection is over its write watermark
+        self.stream_watermark = None
+        self.stream_writable = threading.Condition(self.stream_lock)
+        self.stream_pending = {}
+        self.stream_pending_bytes = {}
+        self.stream_flushing = False
+        self.flush_lock = threading.Lock()
+        if sys.platform != 'win32':
+            self.client.set_connection_callback(RTVTConnectionCallback(self))
 
     def set_quest_timeout(self, timeout):
         self.client.set_quest_timeout(timeout * 1000)
@@ -47,9 +153,33 @@ class RTVTClient(object):
                 self.processor = RTVTQuestProcessorInternalFPNN()
             else:
                 self.processor = RTVTQuestProcessorInternal()
+                self.processor.client = self
+                self.processor.coalescer = self.result_coalescer
         self.processor.set_processor(processor)
         self.client.set_quest_processor(self.processor)
 
+    def set_result_coalescing(self, enable = True):
+        # while the RTVTServerPushMonitor falls behind, a newer temp result of a stream replaces the pending one
+        # with the same lang and taskId. final results are always delivered. results keep their arrival order
+        # in DispatchMode.Ordered and DispatchMode.Inline
+        if sys.platform == 'win32':
+            return
+        self.result_coalescer = RTVTResultCoalescer(self.client.engine.thread_pool_execute) if enable else None
+        if self.processor != None:
+            self.processor.coalescer = self.result_coalescer
+
+    def coalesced_count(self, streamId = None):
+        coalescer = self.result_coalescer
+        if coalescer == None:
+            return 0
+        return coalescer.coalesced_count(streamId)
+
+    def set_dispatch_mode(self, mode):
+        # DispatchMode.Ordered delivers the results of a stream in order, different streams still run in parallel.
+        # DispatchMode.Inline calls the RTVTServerPushMonitor on the IO thread, its methods must return quickly
+        if sys.platform != 'win32':
+            self.client.set_dispatch_mode(mode)
+
     def close(self):
         self.require_close = True
         self.client.close()
@@ -64,6 +194,16 @@ class RTVTClient(object):
         with self.stream_lock:
             self.stream_queue.clear()
             self.stream_seq_map.clear()
+            self.stream_params.clear()
+            self.stream_tail.clear()
+            self.server_stream_map.clear()
+            self.app_stream_map.clear()
+            self.stream_pending.clear()
+            self.stream_pending_bytes.clear()
+            self.stream_ack_interval.clear()
+            self.stream_acked_seq.clear()
+            self.voice_encoders.clear()
+            self.stream_writable.notify_all()
         if sys.platform != 'win32':
             self.client.destory()
         else:
@@ -95,7 +235,175 @@ class RTVTClient(object):
             self.client.setConnectionConnectedCallback(MyConnectedCallback(self.endpoint, self.client.connection_id, callback))
             self.client.setConnectionWillCloseCallback(MyConnectionWillCloseCallback(self.endpoint, self.client.connection_id, callback))
         else:
-            self.client.set_connection_callback(callback)
+            self.connection_callback = callback
+
+    def set_write_watermark(self, watermark):
+        self.client.set_write_watermark(watermark)
+
+    def set_stream_watermark(self, watermark):
+        if watermark != None and not isinstance(watermark, Watermark):
+            raise Exception("watermark type error")
+        with self.stream_lock:
+            self.stream_watermark = watermark
+            self.stream_writable.notify_all()
+        if watermark == None:
+            self.flush_streams()
+
+    def queue_depth(self, streamId = None):
+        if streamId == None:
+            return self.client.queue_depth()
+        with self.stream_lock:
+            pending = self.stream_pending.get(streamId, None)
+            if pending == None:
+                return 0, 0
+            return len(pending), self.stream_pending_bytes[streamId]
+
+    def hold_frame(self, streamId, seq, data):
+        # returns False when the frame can be sent now, otherwise it is kept or dropped by the stream watermark
+        with self.stream_lock:
+            watermark = self.stream_watermark
+            pending = self.stream_pending.get(streamId, None)
+            if watermark == None or pending == None:
+                return False
+            if len(pending) == 0 and not self.stream_flushing and self.client.is_writable():
+                return False
+
+            if watermark.over_high(self.stream_pending_bytes[streamId], len(pending)):
+                if watermark.policy == OverflowPolicy.Block:
+                    while self.stream_pending.get(streamId, None) is pending and self.stream_watermark is watermark \
+                            and not watermark.under_low(self.stream_pending_bytes[streamId], len(pending)):
+                        if not self.stream_flushing and self.client.is_writable():
+                            # nobody is flushing, the frame is queued and flushed from this thread
+                            break
+                        self.stream_writable.wait()
+                    if self.stream_pending.get(streamId, None) is not pending:
+                        return True
+                    if len(pending) == 0 and not self.stream_flushing and self.client.is_writable():
+                        return False
+                elif watermark.policy == OverflowPolicy.Raise:
+                    raise QueueOverflowError("stream " + str(streamId) + " queue is full")
+                elif watermark.policy == OverflowPolicy.DropOldest:
+                    while len(pending) > 0 and watermark.over_high(self.stream_pending_bytes[streamId], len(pending)):
+                        self.stream_pending_bytes[streamId] -= len(pending.popleft()[1])
+                else:
+                    return True
+
+            pending.append((seq, data))
+            self.stream_pending_bytes[streamId] += len(data)
+            writable = not self.stream_flushing and self.client.is_writable()
+
+        if writable:
+            self.flush_streams()
+        return True
+
+    def wake_streams(self):
+        with self.stream_lock:
+            self.stream_writable.notify_all()
+        self.flush_streams()
+
+    def flush_streams(self):
+        with self.flush_lock:
+            while self.client.is_writable():
+                frames = []
+                with self.stream_lock:
+                    # one frame of every stream per round
+                    for (streamId, pending) in self.stream_pending.items():
+                        if len(pending) > 0:
+                            (seq, data) = pending.popleft()
+                            self.stream_pending_bytes[streamId] -= len(data)
+                            frames.append((streamId, self.server_stream_map.get(streamId, streamId), seq, data))
+                    self.stream_flushing = len(frames) > 0
+                    if len(frames) == 0:
+                        return
+                    self.stream_writable.notify_all()
+
+                try:
+                    for (streamId, serverStreamId, seq, data) in frames:
+                        if serverStreamId != None:
+                            self.send_voice_quest(streamId, serverStreamId, seq, data)
+                finally:
+                    with self.stream_lock:
+                        self.stream_flushing = False
+
+    def resume(self, lost = True):
+        with self.stream_lock:
+            if self.resuming > 0 or self.require_close or self.login_params == None:
+                return
+            if lost:
+                for streamId in self.stream_params:
+                    self.server_stream_map[streamId] = None
+            streams = [(streamId, params) for (streamId, params) in self.stream_params.items() if self.server_stream_map.get(streamId, streamId) == None]
+            self.resuming = len(streams) + 1
+
+        if not self.client.connect():
+            with self.stream_lock:
+                self.resuming = 0
+            return
+
+        # login and every voiceStart are pipelined on the new connection
+        token, ts = self.login_params
+        self.client.send_quest(self.login_quest(token, ts), RTVTResumeLoginCallback(self))
+        for (streamId, params) in streams:
+            self.client.send_quest(self.voice_start_quest(*params), RTVTResumeStreamCallback(self, streamId))
+
+    def resume_login_done(self, successed, retry):
+        with self.stream_lock:
+            if successed:
+                self.resuming = max(0, self.resuming - 1)
+                return
+            self.resuming = 0
+            if not retry:
+                # the cached token is rejected, the application has to login again
+                self.login_params = None
+                return
+            if self.require_close or self.resume_retrying:
+                return
+            # the new connection failed, frames stay in the replay tail until the next attempt
+            self.resume_retrying = True
+        engine = self.client.engine
+        engine.timeout_scheduler.add(RESUME_RETRY_INTERVAL, engine.thread_pool_execute, (self.retry_resume, ()))
+
+    def retry_resume(self):
+        with self.stream_lock:
+            self.resume_retrying = False
+        self.resume(False)
+
+    def resume_stream_done(self, streamId, serverStreamId):
+        with self.stream_lock:
+            self.resuming = max(0, self.resuming - 1)
+            if serverStreamId == None or streamId not in self.stream_params:
+                return
+            self.voice_encoders.pop(self.server_stream_map.get(streamId, streamId), None)
+            self.server_stream_map[streamId] = serverStreamId
+            self.app_stream_map = dict((v, k) for (k, v) in self.server_stream_map.items() if v != None and v != k)
+            frames = list(self.stream_tail[streamId])
+
+        for (seq, data) in frames:
+            self.send_voice_quest(streamId, serverStreamId, seq, data)
+
+    def server_stream(self, streamId, seq, data):
+        # returns None while the stream is being resumed, the frame is kept in the replay tail
+        if not self.resume_enabled:
+            return streamId
+        with self.stream_lock:
+            if streamId not in self.stream_params:
+                return streamId
+            self.stream_tail[streamId].append((seq, data))
+            serverStreamId = self.server_stream_map.get(streamId, streamId)
+            if serverStreamId != None or self.resuming > 0 or self.resume_retrying:
+                return serverStreamId
+            if self.login_params == None:
+                # the old stream id is not valid on this session, wait for the application to login again
+                return None
+        self.resume(False)
+        return None
+
+    def map_result_stream(self, params):
+        if len(self.app_stream_map) > 0:
+            streamId = params.get('streamId', None)
+            if streamId in self.app_stream_map:
+                params['streamId'] = self.app_stream_map[streamId]
+        return params
 
     def login(self, token, ts):
 
@@ -112,25 +420,41 @@ class RTVTClient(object):
             except Exception as ex:
                 return False, 10001
         else:
-            quest = Quest("login")
-            quest.param("pid", self.pid)
-            quest.param("token", token)
-            quest.param("ts", ts)
-            quest.param("uid", self.uid)
-            quest.param("version", "rtvt_python_sdk")
-
-            answer = self.client.send_quest(quest)
+            answer = self.client.send_quest(self.login_quest(token, ts))
 
             if answer.is_error():
                 return False, answer.error_code
             else:
                 try:
                     successed = answer.want("successed")
+                    if successed == True:
+                        self.login_params = (token, ts)
                     return successed == True, 0
                 except:
                     return False, 10001
 
-    def create_stream(self, srcLang, destLang, needAsrResult, needTempResult, needTransResult, srcAltLanguage = []):
+    def login_quest(self, token, ts):
+        quest = Quest("login")
+        quest.param("pid", self.pid)
+        quest.param("token", token)
+        quest.param("ts", ts)
+        quest.param("uid", self.uid)
+        quest.param("version", "rtvt_python_sdk")
+        return quest
+
+    def voice_start_quest(self, srcLang, destLang, needAsrResult, needTempResult, needTransResult, srcAltLanguage):
+        quest = Quest("voiceStart")
+        quest.param("asrResult", needAsrResult)
+        quest.param("asrTempResult", needTempResult)
+        quest.param("transResult", needTransResult)
+        quest.param("srcLanguage", srcLang)
+        quest.param("destLanguage", destLang)
+
+        if len(srcAltLanguage) > 0:
+            quest.param("srcAltLanguage", srcAltLanguage)
+        return quest
+
+    def create_stream(self, srcLang, destLang, needAsrResult, needTempResult, needTransResult, srcAltLanguage = [], ackInterval = 1):
         if sys.platform == 'win32':
             try:
                 params = {
@@ -149,7 +473,7 @@ class RTVTClient(object):
                     streamId = answer['streamId']
 
                 with self.stream_lock:
-                    self.stream_queue[streamId] = deque()
+                    self.stream_queue[streamId] = VoiceRingBuffer()
                     self.stream_seq_map[streamId] = 1
 
                 return streamId, 0
@@ -157,17 +481,7 @@ class RTVTClient(object):
             except Exception as ex:
                 return -1, 10001
         else:
-            quest = Quest("voiceStart")
-            quest.param("asrResult", needAsrResult)
-            quest.param("asrTempResult", needTempResult)
-            quest.param("transResult", needTransResult)
-            quest.param("srcLanguage", srcLang)
-            quest.param("destLanguage", destLang)
-
-            if len(srcAltLanguage) > 0:
-                quest.param("srcAltLanguage", srcAltLanguage)
-
-            answer = self.client.send_quest(quest)
+            answer = self.client.send_quest(self.voice_start_quest(srcLang, destLang, needAsrResult, needTempResult, needTransResult, srcAltLanguage))
 
             if answer.is_error():
                 return -1, answer.error_code
@@ -176,8 +490,15 @@ class RTVTClient(object):
                     streamId = answer.want("streamId")
 
                     with self.stream_lock:
-                        self.stream_queue[streamId] = deque()
+                        self.stream_queue[streamId] = VoiceRingBuffer()
                         self.stream_seq_map[streamId] = 1
+                        self.stream_pending[streamId] = deque()
+                        self.stream_pending_bytes[streamId] = 0
+                        self.stream_ack_interval[streamId] = ackInterval
+                        self.stream_acked_seq[streamId] = 0
+                        if self.resume_enabled:
+                            self.stream_params[streamId] = (srcLang, destLang, needAsrResult, needTempResult, needTransResult, srcAltLanguage)
+                            self.stream_tail[streamId] = deque(maxlen = self.replay_frames)
 
                     return streamId, 0
                 except:
@@ -192,7 +513,10 @@ class RTVTClient(object):
                 return 10001
         else:
             quest = Quest("voiceEnd")
-            quest.param("streamId", streamId)
+            with self.stream_lock:
+                serverStreamId = self.server_stream_map.get(streamId, streamId)
+                quest.param("streamId", serverStreamId)
+            self.voice_encoders.pop(serverStreamId, None)
 
             answer = self.client.send_quest(quest)
 
@@ -202,6 +526,17 @@ class RTVTClient(object):
                 with self.stream_lock:
                     del self.stream_queue[streamId]
                     del self.stream_seq_map[streamId]
+                    self.stream_params.pop(streamId, None)
+                    self.stream_tail.pop(streamId, None)
+                    self.stream_pending.pop(streamId, None)
+                    self.stream_pending_bytes.pop(streamId, None)
+                    self.stream_ack_interval.pop(streamId, None)
+                    self.stream_acked_seq.pop(streamId, None)
+                    self.stream_writable.notify_all()
+                    if self.result_coalescer != None:
+                        self.result_coalescer.remove_stream(streamId)
+                    if self.server_stream_map.pop(streamId, None) != None:
+                        self.app_stream_map = dict((v, k) for (k, v) in self.server_stream_map.items() if v != None and v != k)
                 return 0
 
     def send_voice(self, streamId, seq, data):
@@ -217,19 +552,45 @@ class RTVTClient(object):
             except Exception as ex:
                 return 10001
         else:
-            quest = Quest("voiceData")
-            quest.param("streamId", streamId)
-            quest.param("seq", seq)
-            quest.param("data", data)
-            quest.param("ts", int(time.time() * 1000))
+            streamId = self.server_stream(streamId, seq, data)
+            if streamId == None:
+                return 0
 
-            answer = self.client.send_quest(quest)
+            answer = self.client.send_quest(self.voice_quest(streamId, seq, data))
 
             if answer.is_error():
                 return answer.error_code
             else:
                 return 0
 
+    def voice_quest(self, streamId, seq, data, oneway = False):
+        # streamId here is the server stream id, its encoder is kept until the stream is closed
+        encoder = self.voice_encoders.get(streamId, None)
+        if encoder == None:
+            encoder = VoiceFrameEncoder(streamId)
+            self.voice_encoders[streamId] = encoder
+        return encoder.quest(seq, data, int(time.time() * 1000), oneway)
+
+    def send_voice_quest(self, streamId, serverStreamId, seq, data):
+        # ackInterval of the stream: 1 answers every frame, 0 sends oneway frames only,
+        # N answers every Nth frame as a sequence checkpoint
+        interval = self.stream_ack_interval.get(streamId, 1)
+        if interval == 1:
+            self.client.send_quest(self.voice_quest(serverStreamId, seq, data), RTVT_NOOP_CALLBACK)
+        elif interval > 1 and seq % interval == 0:
+            self.client.send_quest(self.voice_quest(serverStreamId, seq, data), RTVTCheckpointCallback(self, streamId, seq))
+        else:
+            self.client.send_quest(self.voice_quest(serverStreamId, seq, data, True))
+
+    def notice_acked(self, streamId, seq):
+        with self.stream_lock:
+            if seq > self.stream_acked_seq.get(streamId, seq):
+                self.stream_acked_seq[streamId] = seq
+
+    def acked_seq(self, streamId):
+        with self.stream_lock:
+            return self.stream_acked_seq.get(streamId, 0)
+
     def send_voice_async(self, streamId, seq, data):
         if sys.platform == 'win32':
             class MyQuestCallback(FpnnCallback):
@@ -243,30 +604,25 @@ class RTVTClient(object):
                 'ts': int(time.time() * 1000)
             }, MyQuestCallback())
         else:
-            quest = Quest("voiceData")
-            quest.param("streamId", streamId)
-            quest.param("seq", seq)
-            quest.param("data", data)
-            quest.param("ts", int(time.time() * 1000))
-
-            class MyCallback(QuestCallback):
-                def callback(self, answer):
-                    pass
-            self.client.send_quest(quest, MyCallback())
+            serverStreamId = self.server_stream(streamId, seq, data)
+            if serverStreamId != None and not self.hold_frame(streamId, seq, data):
+                self.send_voice_quest(streamId, serverStreamId, seq, data)
             return 0
 
     def send_voice_variable(self, streamId, data):
         if isinstance(data, (bytes, bytearray)):
+            frames = None
             with self.stream_lock:
                 if streamId in self.stream_queue:
-                    self.stream_queue[streamId].extend(data)
-                    sendLength = int(len(self.stream_queue[streamId]) / 640)
-                    if sendLength > 0:
-                        for i in range(sendLength):
-                            data = bytes([self.stream_queue[streamId].popleft() for _ in range(640)])
-                            self.send_voice_async(streamId, self.stream_seq_map[streamId], data)
-                            self.stream_seq_map[streamId] += 1
+                    ring_buffer = self.stream_queue[streamId]
+                    ring_buffer.extend(data)
+                    frames = ring_buffer.pop_frames()
+                    seq = self.stream_seq_map[streamId]
+                    self.stream_seq_map[streamId] += len(frames)
+            if frames:
+                for frame in frames:
+                    self.send_voice_async(streamId, seq, frame)
+                    seq += 1
             return 0
         else:
             raise ValueError("data must be bytes or bytearray.")
-
@@ -0,0 +1,60 @@
+#encoding=utf8
+
+__all__ = ('VoiceRingBuffer', )
+
+class VoiceRingBuffer(object):
+    def __init__(self, frame_size = 640, frame_capacity = 64):
+        self.frame_size = frame_size
+        # capacity is always a multiple of frame_size and frames are always
+        # read from a frame boundary, so a frame never wraps around the end
+        self.capacity = frame_size * frame_capacity
+        self.buffer = bytearray(self.capacity)
+        self.view = memoryview(self.buffer)
+        self.read_pos = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, data):
+        length = len(data)
+        if length == 0:
+            return
+        if self.size + length > self.capacity:
+            self.grow(self.size + length)
+        data = memoryview(data).cast('B')
+        write_pos = (self.read_pos + self.size) % self.capacity
+        first = min(length, self.capacity - write_pos)
+        self.view[write_pos:write_pos + first] = data[:first]
+        if first < length:
+            self.view[0:length - first] = data[first:]
+        self.size += length
+
+    def grow(self, need):
+        capacity = self.capacity * 2
+        while capacity < need:
+            capacity *= 2
+        buffer = bytearray(capacity)
+        first = min(self.size, self.capacity - self.read_pos)
+        buffer[0:first] = self.view[self.read_pos:self.read_pos + first]
+        if first < self.size:
+            buffer[first:self.size] = self.view[0:self.size - first]
+        self.view.release()
+        self.buffer = buffer
+        self.view = memoryview(self.buffer)
+        self.capacity = capacity
+        self.read_pos = 0
+
+    def pop_frames(self):
+        count = self.size // self.frame_size
+        frames = []
+        for i in range(count):
+            end = self.read_pos + self.frame_size
+            frames.append(bytes(self.view[self.read_pos:end]))
+            self.read_pos = end % self.capacity
+        self.size -= count * self.frame_size
+        return frames
+
+    def clear(self):
+        self.read_pos = 0
+        self.size = 0
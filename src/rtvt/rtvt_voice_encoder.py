@@ -0,0 +1,75 @@
+#encoding=utf8
+
+import sys
+sys.path.append("..")
+import struct
+import msgpack
+from fpnn.quest import *
+from fpnn.quest import FPNN_FLAG_MSGPACK
+
+__all__ = ('VoiceFrameEncoder', 'VoiceFrameQuest')
+
+PSIZE = struct.Struct('<I')
+PSIZE_SEQ = struct.Struct('<II')
+SEQ_VALUE = struct.Struct('>BI')
+TS_VALUE = struct.Struct('>BQ')
+
+class VoiceFrameEncoder(object):
+    # a voiceData payload is always {streamId, seq, data, ts}: only seq, data and ts
+    # change within a stream, so the method, the keys and the streamId are encoded once
+    def __init__(self, streamId):
+        self.streamId = streamId
+        self.method = b'voiceData'
+        self.oneway_head = struct.pack('<4sBBBB', b'FPNN', 0, FPNN_FLAG_MSGPACK, FpnnMType.FPNN_MT_ONEWAY.value, len(self.method))
+        self.twoway_head = struct.pack('<4sBBBB', b'FPNN', 0, FPNN_FLAG_MSGPACK, FpnnMType.FPNN_MT_TWOWAY.value, len(self.method))
+        self.prefix = self.method + b'\x84' + msgpack.packb('streamId') + msgpack.packb(streamId) + msgpack.packb('seq')
+        self.data_key = msgpack.packb('data')
+        self.ts_key = msgpack.packb('ts')
+        # seq is packed as uint32 and ts as uint64
+        self.fixed_size = len(self.prefix) - len(self.method) + SEQ_VALUE.size + len(self.data_key) + len(self.ts_key) + TS_VALUE.size
+        # frames of a stream nearly always have the same size
+        self.data_head = (None, None)
+
+    def quest(self, seq, data, ts, oneway = False):
+        return VoiceFrameQuest(self, seq, data, ts, oneway)
+
+    def encode(self, sequnce_num, seq, data, ts, oneway = False):
+        length = len(data)
+        (head_length, data_head) = self.data_head
+        if length != head_length:
+            if length < 0x100:
+                data_head = struct.pack('>BB', 0xc4, length)
+            elif length < 0x10000:
+                data_head = struct.pack('>BH', 0xc5, length)
+            else:
+                data_head = struct.pack('>BI', 0xc6, length)
+            self.data_head = (length, data_head)
+        psize = self.fixed_size + len(data_head) + length
+
+        if oneway:
+            header = self.oneway_head + PSIZE.pack(psize)
+        else:
+            header = self.twoway_head + PSIZE_SEQ.pack(psize, sequnce_num)
+
+        return b''.join((header, self.prefix, SEQ_VALUE.pack(0xce, seq), self.data_key, data_head, data, self.ts_key, TS_VALUE.pack(0xcf, ts)))
+
+class VoiceFrameQuest(Quest):
+    def __init__(self, encoder, seq, data, ts, oneway = False):
+        # no header or params map is built, raw() encodes the whole frame
+        self.method = "voiceData"
+        self.oneway = oneway
+        self.sequnce_num = None
+        self.params_map = {}
+        self.encoder = encoder
+        self.seq = seq
+        self.data = data
+        self.ts = ts
+
+    def __str__(self):
+        return 'Quest: seq({0}) method({1}) oneway({2}) params({3})'.format(self.sequnce_num, self.method, self.oneway,
+            str({'streamId': self.encoder.streamId, 'seq': self.seq, 'data': self.data, 'ts': self.ts}))
+
+    def raw(self):
+        if not self.oneway and self.sequnce_num == None:
+            self.sequnce_num = self.next_sequnce_num()
+        return self.encoder.encode(self.sequnce_num, self.seq, self.data, self.ts, self.oneway)
@@ -0,0 +1,64 @@
+#encoding=utf8
+import sys
+sys.path.append("../src")
+import time
+import msgpack
+from fpnn.tcp_connection import unpack_fix_bin
+
+ROUNDS = 20
+REPEAT = 9
+TEXT = '今天的会议主要讨论下个季度的产品规划和市场推广'
+
+def legacy_unpack(payload):
+    try:
+        return msgpack.unpackb(payload)
+    except UnicodeDecodeError:
+        data = msgpack.unpackb(payload, raw = True)
+        fixBinData = {}
+        for (key, value) in data.items():
+            fixBinData[str(key, encoding = "utf8")] = value
+        return fixBinData
+
+def synthetic_corpus():
+    # shaped like the recognizedResult/translatedResult pushes of a zh -> en session,
+    # every fourth text was cut in the middle of a character by the server
+    corpus = []
+    for n in range(1000):
+        asr = TEXT[:n % len(TEXT) + 1].encode('utf-8')
+        if n % 4 == 0:
+            asr = asr[:-1]
+        corpus.append(msgpack.packb({'pid': 80001000, 'streamId': 1234567890123, 'taskId': n,
+            'startTs': 1700000000000 + n * 1000, 'endTs': 1700000000900 + n * 1000, 'recTs': 1700000001000 + n * 1000,
+            'lang': 'zh', 'asr': asr}, use_bin_type = False))
+        corpus.append(msgpack.packb({'pid': 80001000, 'streamId': 1234567890123, 'taskId': n,
+            'startTs': 1700000000000 + n * 1000, 'endTs': 1700000000900 + n * 1000, 'recTs': 1700000001000 + n * 1000,
+            'lang': 'en', 'trans': 'today the meeting discusses the product plan of the next quarter'[:n % 64 + 1]}))
+    return corpus
+
+def run(name, fn, corpus):
+    costs = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        for _ in range(ROUNDS):
+            for payload in corpus:
+                fn(payload)
+        costs.append(time.perf_counter() - start)
+    cost = min(costs)
+    count = ROUNDS * len(corpus)
+    print(f"{name}: {count} payloads in {cost:.3f}s, {count / cost:.0f} payloads/s")
+    return count / cost
+
+if  __name__ == "__main__":
+    corpus = synthetic_corpus()
+    for payload in corpus:
+        legacy = legacy_unpack(payload)
+        single = unpack_fix_bin(payload)
+        assert legacy.keys() == single.keys()
+        assert all(single[key] == legacy[key] or single[key].encode('utf-8') == legacy[key] for key in legacy)
+
+    escaped = corpus[0::8]
+    for (title, payloads) in (("whole corpus", corpus), ("truncated text only", escaped)):
+        print(title)
+        before = run("  unpackb + raw fallback (before)", legacy_unpack, payloads)
+        after = run("  single pass (after)", unpack_fix_bin, payloads)
+        print(f"  speedup: {after / before:.2f}x")
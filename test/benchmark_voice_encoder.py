@@ -0,0 +1,51 @@
+#encoding=utf8
+import sys
+sys.path.append("../src")
+import time
+import msgpack
+from fpnn.quest import Quest
+from rtvt.rtvt_voice_encoder import VoiceFrameEncoder
+
+FRAME_COUNT = 100000
+STREAM_ID = 1234567890123
+DATA = b'\x01' * 640
+
+def generic_path(count):
+    for seq in range(1, count + 1):
+        quest = Quest("voiceData")
+        quest.param("streamId", STREAM_ID)
+        quest.param("seq", seq)
+        quest.param("data", DATA)
+        quest.param("ts", int(time.time() * 1000))
+        quest.raw()
+
+def encoder_path(count):
+    encoder = VoiceFrameEncoder(STREAM_ID)
+    for seq in range(1, count + 1):
+        encoder.quest(seq, DATA, int(time.time() * 1000)).raw()
+
+def payload(raw):
+    # header(12) + seq(4) + method(9)
+    return msgpack.unpackb(raw[25:])
+
+def run(name, fn):
+    start = time.perf_counter()
+    fn(FRAME_COUNT)
+    cost = time.perf_counter() - start
+    print(f"{name}: {FRAME_COUNT} frames in {cost:.3f}s, {FRAME_COUNT / cost:.0f} frames/s")
+    return FRAME_COUNT / cost
+
+if  __name__ == "__main__":
+    quest = Quest("voiceData")
+    quest.param("streamId", STREAM_ID)
+    quest.param("seq", 7)
+    quest.param("data", DATA)
+    quest.param("ts", 1700000000000)
+    quest.sequnce_num = 1
+    encoded = VoiceFrameEncoder(STREAM_ID).quest(7, DATA, 1700000000000)
+    encoded.sequnce_num = 1
+    assert payload(quest.raw()) == payload(encoded.raw())
+
+    before = run("Quest.raw (before)", generic_path)
+    after = run("VoiceFrameEncoder (after)", encoder_path)
+    print(f"speedup: {after / before:.1f}x")
@@ -0,0 +1,42 @@
+#encoding=utf8
+import sys
+sys.path.append("../src")
+import time
+from collections import deque
+from rtvt.rtvt_voice_buffer import VoiceRingBuffer
+
+FRAME_SIZE = 640
+CHUNK_SIZE = 320
+CHUNK_COUNT = 20000
+
+def deque_framing(chunks):
+    queue = deque()
+    frames = 0
+    for chunk in chunks:
+        queue.extend(chunk)
+        for i in range(int(len(queue) / FRAME_SIZE)):
+            data = bytes([queue.popleft() for _ in range(FRAME_SIZE)])
+            frames += 1
+    return frames
+
+def ring_buffer_framing(chunks):
+    ring_buffer = VoiceRingBuffer(FRAME_SIZE)
+    frames = 0
+    for chunk in chunks:
+        ring_buffer.extend(chunk)
+        frames += len(ring_buffer.pop_frames())
+    return frames
+
+def run(name, fn, chunks):
+    start = time.perf_counter()
+    frames = fn(chunks)
+    cost = time.perf_counter() - start
+    print(f"{name}: {frames} frames in {cost:.3f}s, {frames / cost:.0f} frames/s")
+    return frames / cost
+
+if  __name__ == "__main__":
+    chunks = [bytes([i % 256]) * CHUNK_SIZE for i in range(CHUNK_COUNT)]
+
+    before = run("deque (before)", deque_framing, chunks)
+    after = run("ring buffer (after)", ring_buffer_framing, chunks)
+    print(f"speedup: {after / before:.1f}x")
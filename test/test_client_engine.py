@@ -0,0 +1,41 @@
+#encoding=utf8
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "../src"))
+import time
+import threading
+from fpnn.client_engine import ClientEngine
+
+NOTIFY_THREADS = 16
+NOTIFY_DURATION = 2
+
+def test_next_loop_stress_then_stop():
+    engine = ClientEngine()
+    running = True
+
+    def notify():
+        while running:
+            engine.next_loop()
+
+    threads = [threading.Thread(target = notify) for i in range(NOTIFY_THREADS)]
+    for t in threads:
+        t.start()
+    time.sleep(NOTIFY_DURATION)
+    running = False
+    for t in threads:
+        t.join()
+
+    # a swallowed wakeup leaves the flag set and every later next_loop() is ignored
+    time.sleep(0.2)
+    assert not engine.wakeup_pending
+
+    stopper = threading.Thread(target = engine.stop)
+    stopper.daemon = True
+    stopper.start()
+    stopper.join(5)
+    assert not stopper.is_alive(), "stop() did not return"
+    assert not engine.loop_thread.is_alive()
+
+if  __name__ == "__main__":
+    test_next_loop_stress_then_stop()
+    print("next_loop stress ok")